@@ -1,31 +1,56 @@
 import re
 
+def _encode(write, value):
+	if isinstance(value, (str, bytearray)):
+		write(str(len(value)))
+		write(':')
+		write(value)
+	elif isinstance(value, dict):
+		write('d')
+		for key in sorted(value):
+			_encode(write, key)
+			_encode(write, value[key])
+		write('e')
+	elif isinstance(value, (list, tuple)):
+		write('l')
+		for item in value:
+			_encode(write, item)
+		write('e')
+	elif isinstance(value, (int, long)):
+		# %d rather than str, which gives True for a bool
+		write('i%de' % value)
+	else:
+		raise TypeError("Cannot bencode %r" % type(value))
+
+def encode_to(stream, value):
+	"""
+	Write the bencoding of value to a file-like stream, piece by piece,
+	without building the whole encoding in memory first.
+	"""
+	_encode(stream.write, value)
+
+def bencode_into(buffer, value):
+	"""
+	Append the bencoding of value to a bytearray, which is returned so
+	that one buffer can be reused across calls.
+	"""
+	_encode(buffer.extend, value)
+	return buffer
+
 def bencode_string(value):
-	return ":".join([str(len(value)),value])
+	return bencode(value)
 
 def bencode_integer(number):
-	return "i%de"%number
-	
+	return bencode(number)
+
 def bencode_list(values):
-	items = len(values)
-	if items == 0:
-		return "le"
-	return "l%d%se"%(items,"".join(map(bencode, values)))
+	return bencode(list(values))
 
 def bencode_dict(values):
-	encoded_values = ["".join((bencode(k), bencode(v))) for k,v in sorted(values.iteritems())]
-	return "d%se"%"".join(encoded_values)
-	
-	
+	return bencode(dict(values))
+
 def bencode(value):
-	if isinstance(value, str):
-		return bencode_string(value)
-	if isinstance(value, dict):
-		return bencode_dict(value)
-	if isinstance(value, list):
-		return bencode_list(value)
-	else:
-		return bencode_integer(value)
+	return str(bencode_into(bytearray(), value))
 
 def bendecode_string(value):
 	(size,remainder) = value.split(':',1)
@@ -71,5 +96,91 @@ def bendecode_chunk(string):
 		return bendecode_dict(string)
 	raise Exception('Unsupported type %s %s'%(first,repr(string)))
 
-def bendecode(string):
-	return bendecode_chunk(string)[0]
\ No newline at end of file
+class BencodeError(ValueError):
+	"""
+	Raised when bencoded data is truncated or malformed. The offset of
+	the problem in the input buffer is kept in the offset attribute.
+	"""
+	def __init__(self, message, offset):
+		ValueError.__init__(self, "%s at offset %d" % (message, offset))
+		self.offset = offset
+
+_integer = re.compile(r'-?(0|[1-9][0-9]*)$')
+
+def _buffer(data):
+	# memoryview has no find() on Python 2, so copy it out once;
+	# str, bytearray and mmap objects are walked in place.
+	if isinstance(data, memoryview):
+		return data.tobytes()
+	return data
+
+def bendecode_at(data, index=0, spans=None):
+	"""
+	Decode the value that starts at index in data, returning a
+	(value, next_index) tuple. Nothing after the value is copied, so
+	walking a whole buffer this way is linear in its size.
+
+	If the value is a dictionary and spans is given, any of its keys
+	that appear in spans are set to the (start, end) offsets of the
+	matching encoded value in data.
+	"""
+	end = len(data)
+	if index >= end:
+		raise BencodeError("Unexpected end of data", index)
+	first = data[index:index+1]
+	if first == 'i':
+		close = data.find('e', index + 1)
+		if close == -1:
+			raise BencodeError("Unterminated integer", index)
+		digits = bytes(data[index+1:close])
+		if not _integer.match(digits) or digits == '-0':
+			raise BencodeError("Invalid integer %r" % digits, index)
+		return (int(digits), close + 1)
+	if first == 'l':
+		result = []
+		index += 1
+		while data[index:index+1] != 'e':
+			if index >= end:
+				raise BencodeError("Unterminated list", index)
+			(item, index) = bendecode_at(data, index)
+			result.append(item)
+		return (result, index + 1)
+	if first == 'd':
+		result = {}
+		index += 1
+		while data[index:index+1] != 'e':
+			if index >= end:
+				raise BencodeError("Unterminated dictionary", index)
+			if not data[index:index+1].isdigit():
+				raise BencodeError("Dictionary key is not a string", index)
+			(key, index) = bendecode_at(data, index)
+			start = index
+			(result[key], index) = bendecode_at(data, index)
+			if spans is not None and key in spans:
+				spans[key] = (start, index)
+		return (result, index + 1)
+	if first.isdigit():
+		colon = data.find(':', index)
+		if colon == -1:
+			raise BencodeError("Unterminated string length", index)
+		size = bytes(data[index:colon])
+		if not size.isdigit():
+			raise BencodeError("Invalid string length %r" % size, index)
+		start = colon + 1
+		stop = start + int(size)
+		if stop > end:
+			raise BencodeError("String of length %s is truncated" % size, index)
+		return (bytes(data[start:stop]), stop)
+	raise BencodeError("Unsupported type %r" % first, index)
+
+def bendecode(string, spans=None):
+	"""
+	Decode a complete bencoded value. Accepts str, bytearray, memoryview
+	or mmap input; trailing data after the value is an error. See
+	bendecode_at for spans.
+	"""
+	data = _buffer(string)
+	(value, index) = bendecode_at(data, 0, spans)
+	if index != len(data):
+		raise BencodeError("Trailing data after value", index)
+	return value
\ No newline at end of file
@@ -0,0 +1,129 @@
+import binascii
+
+# Offsets of the set bits in each byte value, most significant bit first
+_set_bits = [tuple(bit for bit in range(8) if value & (0x80 >> bit)) for value in range(256)]
+
+class Bitfield(object):
+	"""
+	A set of piece indexes kept in the BitTorrent wire format: one bit per
+	piece, with piece 0 in the high bit of the first byte. Bulk operations
+	work on the whole bitfield at once as a long integer, which is much
+	faster on Python 2 than a loop over the bytes. Counting the pieces
+	costs about as much as the operation, so it waits until len() is
+	called.
+	"""
+	__slots__ = ('length', 'bits', '_count')
+
+	def __init__(self, length, data=None):
+		size = (length + 7) // 8
+		self.length = length
+		if data is None:
+			self.bits = bytearray(size)
+			self._count = 0
+			return
+		if len(data) != size:
+			raise ValueError("Bitfield of %d bytes given for %d pieces" % (len(data), length))
+		self.bits = bytearray(data)
+		spare = size * 8 - length
+		if spare:
+			# Bits past the last piece must be clear
+			self.bits[-1] &= (0xff << spare) & 0xff
+		self._count = None
+
+	@classmethod
+	def from_int(cls, length, value):
+		size = (length + 7) // 8
+		if not size:
+			return cls(length)
+		return cls(length, binascii.unhexlify('%0*x' % (size * 2, value)))
+
+	@classmethod
+	def _from_int(cls, length, value):
+		"""from_int for the result of a bulk operation, which is known to be valid."""
+		result = cls.__new__(cls)
+		result.length = length
+		result.bits = bytearray.fromhex('%0*x' % (((length + 7) // 8) * 2, value)) if length else bytearray()
+		result._count = None if value else 0
+		return result
+
+	@classmethod
+	def full(cls, length):
+		"""A bitfield with every piece set."""
+		return cls(length, '\xff' * ((length + 7) // 8))
+
+	def to_int(self):
+		if not self.bits:
+			return 0
+		return int(binascii.hexlify(self.bits), 16)
+
+	def popcount(self):
+		return bin(self.to_int()).count('1')
+
+	def add(self, index):
+		if not 0 <= index < self.length:
+			raise IndexError("piece %d out of range" % index)
+		mask = 0x80 >> (index & 7)
+		byte = self.bits[index >> 3]
+		if not byte & mask:
+			self.bits[index >> 3] = byte | mask
+			if self._count is not None:
+				self._count += 1
+
+	def discard(self, index):
+		if index in self:
+			self.bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+			if self._count is not None:
+				self._count -= 1
+
+	def __contains__(self, index):
+		return 0 <= index < self.length and bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+	def __len__(self):
+		if self._count is None:
+			self._count = self.popcount()
+		return self._count
+
+	def __nonzero__(self):
+		if self._count is not None:
+			return bool(self._count)
+		return self.bits.count('\x00') != len(self.bits)
+
+	def __iter__(self):
+		for (offset, byte) in enumerate(self.bits):
+			if byte:
+				base = offset * 8
+				for bit in _set_bits[byte]:
+					yield base + bit
+
+	def _check(self, other):
+		if self.length != other.length:
+			raise ValueError("Bitfields of %d and %d pieces" % (self.length, other.length))
+
+	def __and__(self, other):
+		self._check(other)
+		return Bitfield._from_int(self.length, self.to_int() & other.to_int())
+
+	def __or__(self, other):
+		self._check(other)
+		return Bitfield._from_int(self.length, self.to_int() | other.to_int())
+
+	def andnot(self, other):
+		"""The pieces in this bitfield that aren't in other."""
+		self._check(other)
+		return Bitfield._from_int(self.length, self.to_int() & ~other.to_int())
+
+	def tobytes(self):
+		"""
+		The wire format, as a str. It has to be a copy: Twisted on Python 2
+		joins what it is given to write as strs, so won't take a view.
+		"""
+		return str(self.bits)
+
+	def __eq__(self, other):
+		return isinstance(other, Bitfield) and self.length == other.length and self.bits == other.bits
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return "Bitfield(%d, %r)" % (self.length, str(self.bits))
@@ -0,0 +1,88 @@
+import collections
+import random
+
+class RateMeter(object):
+	"""
+	The rate of a running byte count, in bytes per second, over roughly
+	the last window seconds of samples.
+	"""
+	__slots__ = ('window', 'samples')
+
+	def __init__(self, window=20.0):
+		self.window = window
+		self.samples = collections.deque()
+
+	def update(self, total, now):
+		self.samples.append((now, total))
+		# Keep the newest sample at least window seconds old
+		while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+			self.samples.popleft()
+
+	@property
+	def rate(self):
+		if len(self.samples) < 2:
+			return 0.0
+		((start, first), (end, last)) = (self.samples[0], self.samples[-1])
+		if end <= start:
+			return 0.0
+		return (last - first) / float(end - start)
+
+class Choker(object):
+	"""
+	Tit-for-tat choking. Each round the interested peers that have sent us
+	the most lately get all but one of the upload slots; when seeding it
+	is those we have sent the most to instead. The last slot is an
+	optimistic unchoke of some other interested peer, chosen at random
+	and moved on every optimistic_rounds rounds, so new peers get a
+	chance to show what they can do.
+
+	CHOKE and UNCHOKE are only sent to peers whose state changes.
+	"""
+
+	def __init__(self, upload_slots=4, optimistic_rounds=3):
+		self.upload_slots = upload_slots
+		self.optimistic_rounds = optimistic_rounds
+		self.optimistic = None
+		self.round = 0
+
+	def rechoke(self, peers, seeding, now):
+		for peer in peers:
+			peer.download_rate.update(peer.received, now)
+			peer.upload_rate.update(peer.sent, now)
+		interested = [peer for peer in peers if peer.interested]
+		if seeding:
+			interested.sort(key=lambda peer: peer.upload_rate.rate, reverse=True)
+		else:
+			interested.sort(key=lambda peer: peer.download_rate.rate, reverse=True)
+		unchoke = set(interested[:max(self.upload_slots - 1, 0)])
+
+		optimistic = self.optimistic
+		if self.round % self.optimistic_rounds == 0 or optimistic not in set(interested) or optimistic in unchoke:
+			others = [peer for peer in interested if peer not in unchoke]
+			optimistic = random.choice(others) if others else None
+		self.optimistic = optimistic
+		if optimistic is not None:
+			unchoke.add(optimistic)
+		self.round += 1
+
+		for peer in peers:
+			if peer in unchoke:
+				self.unchoke(peer)
+			else:
+				self.choke(peer)
+
+	def choke(self, peer):
+		if not peer.am_choking:
+			peer.am_choking = True
+			# Requests it has queued with us are dropped
+			peer.requests.clear()
+			peer.connection.send_CHOKE()
+
+	def unchoke(self, peer):
+		if peer.am_choking:
+			peer.am_choking = False
+			peer.connection.send_UNCHOKE()
+
+	def remove(self, peer):
+		if self.optimistic is peer:
+			self.optimistic = None
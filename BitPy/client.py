@@ -1,9 +1,9 @@
 import random
-import requests
 import bencode
 import logging
 
-import math
+import collections
+
 import hashlib
 
 import bisect
@@ -11,75 +11,177 @@ import bisect
 import os
 
 import itertools
+import time
 
-from twisted.internet import task,reactor
+from twisted.internet import defer,task,reactor,threads
 
+import bitfield
+import choker
+import haves
+import intervals
+import peers
+import picker
+import pipeline
 import protocol
+import ratelimit
+import resume
+import storage
+import timers
+import tracker
+import verify
 
 class Download():
 	logger = logging.getLogger(__name__)
 
-	def __init__(self, torrent, filename=None, file=None):
+	def __init__(self, torrent, filename=None, file=None, directory='.', check=True, resume_file=None, hash_queue=None):
+		"""
+		Data is kept in file if one is given. Otherwise it goes in the
+		torrent's own files under directory; filename overrides the path
+		of a single file torrent, or the directory for a multi-file one.
+		If check is False, existing data is not hashed until
+		check_progress or check_progress_in_background is called.
+
+		Fast-resume data is kept in resume_file, by default next to the
+		data as <name>.resume. When the files haven't changed since it was
+		written it is trusted instead of hashing everything again.
+
+		Completed pieces are hashed through hash_queue; by default they
+		are hashed inline.
+		"""
 		self.torrent = torrent
 		self.peers = []
-		self.pieces = set()
+		self.pieces = bitfield.Bitfield(torrent.info.num_pieces)
 		self.piece_state = {}
 		self.tracker_id = None
 		self.connected_peers = []
-		
-		self.filename = 'torrent.dat'
-		
-		
-		if self.torrent.info.filemode == 'single':
-			self.filename = os.sep.join(self.torrent.info.files[0]['path'])
-			
-		if filename:
-			self.filename = filename
-		
+		self.needs_check = False
+		self.check_pieces = None
+		self.checking = False
+		self.resume_file = None
+		self.hashing = set()
+		self.hash_queue = hash_queue if hash_queue is not None else verify.HashQueue(run=defer.maybeDeferred)
+
 		if file:
-			self.file = file
+			self.storage = storage.WriteCache(storage.FileStorage(self.torrent.info, file))
+			self.read_cache = storage.ReadCache(self.storage)
 			return
-		
-		if not os.path.exists(self.filename):
-			self.logger.debug("Creating file %s", self.filename)
-			open('file', 'w').close()
-		
-		self.file = open(self.filename, "r+b")
-
-		if os.path.getsize(self.filename) != self.torrent.info.size:
-			self.logger.info("Creating file %s as size(%d) is wrong (should be %d)",self.filename,os.path.getsize(self.filename),self.torrent.info.size)
-			self.file.seek(self.torrent.info.size -1)
-			self.file.write('\0')
-			self.file.truncate()
-			self.file.seek(0)
-			
-		else:
+
+		paths = None
+		if filename and self.torrent.info.filemode == 'single':
+			paths = [filename]
+		elif filename:
+			directory = filename
+		self.storage = storage.WriteCache(storage.Storage(self.torrent.info, directory, paths))
+		self.read_cache = storage.ReadCache(self.storage)
+		if resume_file is None:
+			resume_file = (paths[0] if paths else os.path.join(directory, self.torrent.info.name)) + '.resume'
+		self.resume_file = resume_file
+
+		self.needs_check = self.storage.allocate()
+		if self.needs_check:
+			self.load_resume()
+		if self.needs_check and check:
 			self.check_progress()
 
-	def check_progress(self):
-		self.logger.info("Loading %d pieces from %s",self.torrent.info.num_pieces,self.filename)
+	def load_resume(self):
+		"""
+		Restore progress from the fast-resume file, leaving only the pieces
+		of files changed since it was written to be checked. Returns False
+		if there was no usable resume data.
+		"""
+		result = resume.load(self.resume_file, self.torrent.info_hash, self.torrent.info.layout, self.storage.storage.paths)
+		if result is None:
+			return False
+		(self.pieces, self.piece_state, self.check_pieces) = result
+		self.needs_check = bool(self.check_pieces)
+		self.logger.info("Resumed %d completed pieces from %s, %d to check", len(self.pieces), self.resume_file, len(self.check_pieces))
+		return True
+
+	def save_resume(self):
+		# Until the check is done we don't know what we have
+		if self.resume_file is None or self.needs_check or self.checking:
+			return
+		self.storage.flush()
+		resume.save(self.resume_file, self.torrent.info_hash, self.pieces, self.piece_state, self.storage.storage.paths)
+
+	def flush(self):
+		self.storage.flush()
+
+	def close(self):
+		self.storage.flush()
+		self.save_resume()
+		self.storage.close()
+
+	def check_progress(self, workers=None):
+		"""
+		Hash the data already on disk and mark every piece that matches.
+		Returns the number of completed pieces found.
+		"""
+		pieces = self.pop_check_pieces()
+		self.logger.info("Loading %d pieces of %s",len(pieces),self.torrent.info.name)
+		start = time.time()
 		count = 0
-		for piece in range(self.torrent.info.num_pieces):
-			if self.verify_piece(piece):
+		for (piece, ok) in verify.verify_pieces(self.storage.storage, self.torrent.info, pieces, workers):
+			if ok:
+				self.piece_verified(piece)
 				count += 1
-		self.logger.info("Loaded %d completed pieces, progress is %f", count, self.progress)
-			
+		elapsed = max(time.time() - start, 0.001)
+		checked = sum(self.piece_size(piece) for piece in pieces)
+		self.logger.info("Loaded %d completed pieces, progress is %f (%.1f MB/s)", count, self.progress, checked / elapsed / 2**20)
+		return count
+
+	def pop_check_pieces(self):
+		pieces = self.check_pieces
+		if pieces is None:
+			pieces = xrange(self.torrent.info.num_pieces)
+		self.check_pieces = None
+		self.needs_check = False
+		return pieces
+
+	def check_progress_in_background(self, found=None, workers=None):
+		"""
+		Like check_progress, but hashes on another thread through its own
+		file handles, so the client can run while the check goes on. Each
+		completed piece is marked on the reactor thread as soon as it is
+		hashed, and passed to found if given. Returns a Deferred that fires
+		with the number of completed pieces found.
+		"""
+		pieces = self.pop_check_pieces()
+		self.checking = True
+		def piece_found(piece):
+			if self.piece_verified(piece) and found:
+				found(piece)
+		def check():
+			count = 0
+			reader = self.storage.storage.reopen()
+			try:
+				for (piece, ok) in verify.verify_pieces(reader, self.torrent.info, pieces, workers):
+					if ok:
+						reactor.callFromThread(piece_found, piece)
+						count += 1
+			finally:
+				reader.close()
+			return count
+		def done(result):
+			self.checking = False
+			return result
+		return threads.deferToThread(check).addBoth(done)
+
+	def piece_verified(self, index):
+		"""
+		Mark a piece found complete on disk, returning False if we
+		already had it.
+		"""
+		if index in self.pieces:
+			return False
+		self.pieces.add(index)
+		self.piece_state.pop(index, None)
+		self.storage.discard(index)
+		return True
 
 	@property
 	def bitfield(self):
-		num_pieces = self.torrent.info.num_pieces
-
-		bitfield = list('\x00' * int(math.ceil(num_pieces / 8.0)))
-
-		#self.logger.debug("State is %s", repr(self.piece_state))
-
-		for piece in self.pieces:
-			#self.logger.debug("Have piece %d",piece)
-			index = piece // 8
-			bit   = 7 - (piece % 8)
-			bitfield[index] = chr(ord(bitfield[index]) | (1 << bit))
-			#self.logger.debug("index is %d, bit is %d, bitfield is %s", index,bit,bitfield)
-		return bitfield
+		return self.pieces
 	
 	@property
 	def finished_pieces(self):
@@ -91,21 +193,46 @@ class Download():
 		return self.finished_pieces/float(pieces)
 
 	def get_piece(self,index,start=0, length=None):
-		self.seek_block_part(index,start)
-		readsize = length if length else self.piece_size(index)
-		return self.file.read(readsize)
+		readsize = length if length else self.piece_size(index) - start
+		if index in self.pieces:
+			return self.read_cache.read(index,start,readsize,self.piece_size(index))
+		return self.storage.read(index,start,readsize)
 
 	
 	def verify_piece(self, index):
 		piece = self.get_piece(index)
-		sha1 = hashlib.sha1()
-		sha1.update(piece)
-		hash = sha1.digest()
+		return self.piece_hashed(index, piece, hashlib.sha1(piece).digest())
+
+	def verify_piece_async(self, index):
+		"""
+		Hash a complete piece through the hash queue, from the copy still
+		held in the write cache. Returns a Deferred that fires with whether
+		the piece checked out.
+		"""
+		piece = self.storage.read(index, 0, self.piece_size(index))
+		self.hashing.add(index)
+		def hashed(digest):
+			self.hashing.discard(index)
+			return self.piece_hashed(index, piece, digest)
+		def failed(failure):
+			self.logger.warn("Hashing piece %d failed: %s", index, failure.getErrorMessage())
+			# Throw the piece away as if it didn't match, to download again
+			return hashed(None)
+		return self.hash_queue.sha1(piece).addCallbacks(hashed, failed)
+
+	def piece_hashed(self, index, piece, hash):
+		if index in self.pieces:
+			return True
 		if hash == self.torrent.info.pieces[index]:
+			# Written out when the cache fills or is flushed
+			self.storage.mark_verified(index)
 			self.pieces.add(index)
+			# Peers are likely to ask for a piece we've just announced
+			self.read_cache.add(index, piece)
 			self.logger.debug("Piece %d verified, progress is %f",index,self.progress)
 			return True
 		#self.logger.debug("Piece %d failed hash check",index)
+		self.storage.discard(index)
 		if index in self.piece_state:
 			del self.piece_state[index]
 		return False
@@ -118,144 +245,109 @@ class Download():
 	def piece_progress(self, index):
 		if self.have_piece(index):
 			return 1
-		piece_size = self.piece_size(index)
-		if index not in self.piece_state:
+		state = self.piece_state.get(index)
+		if not state:
 			return 0
-
-		current_end_byte = 0
-		missing = 0
-		
-
-		
-		for (start,next_byte) in self.piece_state[index]:
-			missing = missing + start - current_end_byte
-			current_end_byte = next_byte
-
-		missing = missing + piece_size - current_end_byte
-
-		return (piece_size - missing) / float(piece_size)
+		return state.size / float(self.piece_size(index))
 
 	def have_piece_range(self,index,start,length):
-		if index not in self.piece_state:
-			return False
-		if length <= 0:
-			return True
-
-		next = 0
-
-		for (s,n) in self.piece_state[index]:
-			if s < next:
-				continue
-			# Start is somewhere in this block,
-			# so we can just advance it to the next point,
-			# reducing length by the amount we skip
-			if start >= s and start <= n:
-				skip = n - start
-				start += skip
-				length -= skip
-			if length <= 0:
-				return True
-			next = n
-
-	def seek_block_part(self,piece,offset=0):
-		self.file.seek(piece * self.torrent.info.piece_length + offset)
-		#return mmap.mmap(self.file, self.piece_size(piece), offset=piece * self.torrent.info.piece_length)
+		state = self.piece_state.get(index)
+		return state is not None and state.covers(start, start + length)
 
 	def store_piece(self, index, begin, data):
-		if self.have_piece(index):
+		"""
+		Store a block of a piece. When this completes the piece, returns a
+		Deferred that fires with whether the piece passed its hash check.
+		"""
+		if self.have_piece(index) or index in self.hashing:
 			return
-			
-		data_size = len(data)
 
 		file_offset = index * self.torrent.info.piece_length + begin
 
-		assert file_offset + len(data) <= self.torrent.info.size
-		self.seek_block_part(index,begin)
-		self.file.write(data)
-		self.file.flush()
-
-		state = self.piece_state.get(index, [])
-		
-		inserted = False
-		
-		insert_pos = -1
-		
-		
-		for i in range(len(state)):
-			(start, last) = state[i]
-			if last == begin:
-				state[i] = (start, begin+data_size)
-				(start, last) = state[i]
-				insert_pos = i
-				inserted = True
-				self.logger.debug("Growing piece %d to %d,%d"%(index,start,begin+data_size))
-		if inserted:
-			if insert_pos+1 < len(state):
-				if begin + data_size == state[insert_pos+1][0]:
-					state[insert_pos] = (state[insert_pos][0],state[insert_pos+1][1])
-					del state[insert_pos+1]
-		else:		
-			state.append((begin, begin+data_size))
-			state.sort()
+		assert file_offset + len(data) <= self.torrent.info.layout.size
+		self.storage.write(index,begin,data)
 
+		state = self.piece_state.get(index)
+		if state is None:
+			state = self.piece_state[index] = intervals.IntervalSet()
+		state.add(begin, begin + len(data))
 		self.logger.debug("State is %s", state)
 
-		self.piece_state[index] = state
-		
-		if self.piece_progress(index) == 1:
-			self.verify_piece(index)
-
-
-
+		if state.size == self.piece_size(index):
+			return self.verify_piece_async(index)
 
 	def piece_size(self,index):
-		if index < (self.torrent.info.num_pieces - 1):
-			return self.torrent.info.piece_length
-		else:
-			return self.torrent.info.size - (self.torrent.info.num_pieces - 1)* self.torrent.info.piece_length 
+		return self.torrent.info.layout.piece_size(index)
 
 	@property
 	def missing_pieces(self):
 		return [piece for piece in xrange(0,len(self.torrent.info.pieces)) if not self.have_piece(piece)]
 
+	def missing_blocks(self, block_size):
+		"""Yield (piece, begin, length) for every block we don't have yet."""
+		for piece in bitfield.Bitfield.full(self.torrent.info.num_pieces).andnot(self.bitfield):
+			size = self.piece_size(piece)
+			for begin in xrange(0, size, block_size):
+				length = min(block_size, size - begin)
+				if not self.have_piece_range(piece, begin, length):
+					yield (piece, begin, length)
+
 class Peer():
 	def __init__(self, host, port, peer_id=None, pieces=0):
 		self.peer_id = peer_id
 		self.host = host
 		self.port = port
-		self.bitfield = list('\x00' * int(math.ceil(pieces / 8.0)))
-		self._choked = True
+		self.bitfield = bitfield.Bitfield(pieces)
+		self.choked = True
 		self.interested = False
-		self.requests = set()
+		self.am_choking = True
+		self.am_interested = False
+		self.pipeline = pipeline.Pipeline()
+		self.connection = None
+		# Blocks the peer has asked us for, oldest first
+		self.requests = collections.OrderedDict()
 		self.received = 0
 		self.sent = 0
+		self.download_rate = choker.RateMeter()
+		self.upload_rate = choker.RateMeter()
+		self.bandwidth = ratelimit.Bandwidth()
 	
 	def __hash__(self):
 		return hash((self.host,self.port))
 	
 	def __eq__(self,other):
-		return self.host == other.host and self.port == other.port
-	
-	@property
-	def choked(self):
-		return self._choked
-	
-	@choked.setter
-	def choked(self,value):
-		self._choked = value
-		if self.choked:
-			self.requests = set()
+		return isinstance(other, Peer) and self.host == other.host and self.port == other.port
 
+	def __ne__(self, other):
+		return not self == other
+	
 	def set_have(self, piece):
-		index = piece // 8
-		bit   = 7 - (piece % 8)
-		self.bitfield[index] = chr(ord(self.bitfield[index]) | (1 << bit))
+		self.bitfield.add(piece)
 
-	def set_bitfield(self, bitfield):
-		self.bitfield = list(bitfield)
+	def set_bitfield(self, bits):
+		"""Replace the peer's pieces with a wire bitfield, or clear them for None."""
+		self.bitfield = bitfield.Bitfield(self.bitfield.length, bits)
 
-	def add_request(self, index, begin, length):
-		self.requests.append((index,begin,length))
+	def add_request(self, index, begin, length, max_requests):
+		"""
+		Queue a block the peer has asked for, returning False if it was
+		already queued or the queue is full.
+		"""
+		request = (index,begin,length)
+		if request in self.requests or len(self.requests) >= max_requests:
+			return False
+		self.requests[request] = None
+		return True
+
+	def next_request(self):
+		return self.requests.popitem(last=False)[0]
+
+	def cancel_request(self, index, begin, length):
+		request = (index,begin,length)
+		if request not in self.requests:
+			return False
+		del self.requests[request]
+		return True
 
 	def __repr__(self):
 		#'bitfield': self.bitfield
@@ -266,35 +358,60 @@ class Client():
 	logger = logging.getLogger('client')
 
 
-	def __init__(self, torrent, file=None):
+	def __init__(self, torrent, file=None, bandwidth=None):
+		"""
+		Transfers are held to the limits of bandwidth, shared with other
+		torrents, as well as to this torrent's own limits in
+		self.bandwidth and to peer_upload_rate and peer_download_rate
+		for each peer. Every limit is off by default.
+		"""
 		self.uploaded = 0
 		self.downloaded = 0
 		self.peers_wanted = 300
 		self.peer_connection_max = 10
 		self.peer_id = '-TR' + ''.join(chr(random.randint(0x61,0x7a)) for _ in range(17))
 		self.key = ''.join(chr(random.randint(0x61,0x7a)) for _ in range(20))
-		self.peers = []
-		self.connected_peers = []
+		self.peers = peers.PeerRegistry()
 		self.torrent = torrent
-		self.download = Download(torrent,file=file)
+		self.download = Download(torrent,file=file,check=False,hash_queue=verify.HashQueue())
+		self.picker = picker.PiecePicker(torrent.info.num_pieces)
 		self.port = 8123
+		self.tracker = tracker.Tracker(torrent.announce, torrent.announce_list)
 		self.tracker_id = None
-		self.requests = set()
-		self.peer_start = 0
+		self.tracker_call = None
+		self.stopped = False
+		self.choker = choker.Choker()
+		self.global_bandwidth = bandwidth if bandwidth is not None else ratelimit.global_bandwidth
+		self.bandwidth = ratelimit.Bandwidth()
+		self.peer_upload_rate = None
+		self.peer_download_rate = None
 		self.disable_announce = False
-		self.request_buffer_size=50
-		self.live_requests = 0
-		self.inprogress_requests = set()
-		self.requested_parts = set()
+		self.block_size = 2**14
+		self.max_block_size = 2**17
+		self.max_upload_requests = 256
+		self.request_timeout = 30
+		# How many peers each outstanding block has been asked of
+		self.requested_parts = collections.Counter()
+		self.endgame_blocks = 64
+		self.endgame_peers = 3
+		self.endgame = False
+		self.request_timers = timers.TimerWheel(self.request_timeout, now=reactor.seconds())
+		self.resume_interval = 300
+		self.haves = haves.HaveBatcher(lambda: self.connected_peers)
+		# Pieces left out of the bitfield sent to new peers and announced
+		# after it instead, so the bitfield doesn't give away a complete
+		# copy. Off when 0.
+		self.lazy_bitfield = 0
+
+	@property
+	def connected_peers(self):
+		return self.peers.connected
 
 	def check_peers(self):
 		peers_to_get = self.peer_connection_max - len(self.connected_peers)
 		self.logger.info("Trying to get %d peers", peers_to_get)
-		for i in range(self.peer_start,min(len(self.peers),self.peer_start + peers_to_get)):
-			self.connect_peer(self.peers[i])
-		self.peer_start += peers_to_get
-		if self.peer_start > len(self.peers):
-			self.peer_start = 0
+		for peer in self.peers.next_candidates(peers_to_get):
+			self.connect_peer(peer)
 
 	def listen_for_connections(self):
 		return reactor.listenTCP(self.port, protocol.PeerClientFactory(self))
@@ -303,14 +420,89 @@ class Client():
 		return reactor.connectTCP(peer.host, peer.port, protocol.PeerClientFactory(self))
 	
 	def disconnect_peer(self,peer):
-		if peer in self.connected_peers:
-			self.connected_peers.remove(peer)
+		if self.peers.disconnect(peer):
+			self.picker.remove_peer(peer.bitfield)
+			peer.set_bitfield(None)
+			peer.am_interested = False
+			peer.am_choking = True
+			peer.interested = False
+			self.choker.remove(peer)
+			self.release_requests(peer)
+			self.fill_pipelines()
 			#self.check_peers()
 
+	def handle_bitfield(self, peer, bits):
+		try:
+			pieces = bitfield.Bitfield(peer.bitfield.length, bits)
+		except ValueError as e:
+			self.logger.info("Dropping peer %s: %s", peer, e)
+			peer.connection.disconnect()
+			return
+		self.picker.remove_peer(peer.bitfield)
+		peer.bitfield = pieces
+		self.picker.add_peer(peer.bitfield)
+		self.update_interest(peer)
+
+	def handle_have(self, peer, index):
+		if not 0 <= index < peer.bitfield.length:
+			self.logger.info("Dropping peer %s for a HAVE of piece %d", peer, index)
+			peer.connection.disconnect()
+			return
+		if index not in peer.bitfield:
+			peer.set_have(index)
+			self.picker.increment(index)
+			if index not in self.download.pieces:
+				self.set_interested(peer, True)
+			self.fill_pipeline(peer)
+
+	def update_interest(self, peer):
+		"""Tell a peer whether it has anything we need, if that has changed."""
+		if not peer.connection:
+			return
+		self.set_interested(peer, bool(peer.bitfield.andnot(self.download.bitfield)))
+		self.fill_pipeline(peer)
+
+	def set_interested(self, peer, interested):
+		if interested == peer.am_interested:
+			return
+		peer.am_interested = interested
+		if interested:
+			peer.connection.send_INTERESTED()
+		else:
+			peer.connection.send_NOT_INTERESTED()
+
+	def handle_choke(self, peer):
+		peer.choked = True
+		# A peer drops the requests it had from us when it chokes us
+		self.release_requests(peer)
+		self.fill_pipelines()
+
+	def handle_unchoke(self, peer):
+		peer.choked = False
+		self.fill_pipeline(peer)
+
+	def handle_cancel(self, peer, index, begin, length):
+		peer.cancel_request(index, begin, length)
+
+	def queue_request(self, peer, index, begin, length):
+		"""
+		Queue a block a peer has asked for, to be sent by its connection's
+		upload producer. Returns False if the request was rejected: when
+		we choke the peer, don't have the piece, the block is out of range
+		or too big, or it is already queued or the queue is full.
+		"""
+		if peer.am_choking or not self.download.have_piece(index):
+			return False
+		if not 0 < length <= self.max_block_size or begin + length > self.download.piece_size(index):
+			self.logger.debug("Rejecting request for %d:%d+%d from %s", index, begin, length, peer)
+			return False
+		return peer.add_request(index, begin, length, self.max_upload_requests)
+
 	def handle_request(self,peer,request):
 		piece,begin,length = request
-		if self.download.have_piece(piece) and not peer.choked:
+		if self.download.have_piece(piece) and not peer.am_choking:
 			peer.sent += length
+			self.uploaded += length
 			peer.connection.send_PIECE(piece,begin,self.download.get_piece(piece,begin,length))
 			
 	def handle_piece(self, peer, index, begin, data):
@@ -318,47 +510,65 @@ class Client():
 		When a peer finishes downloading a piece and checks that the hash matches, it announces that it has that piece to all of its peers.
 
 		"""
-		self.download.store_piece(index,begin,data)
+		if peer.pipeline.received(index,begin,len(data),reactor.seconds()):
+			asked = self.requested_parts.pop((index,begin), 0)
+			self.request_timers.cancel((peer,index,begin))
+			if asked > 1:
+				self.cancel_duplicates(peer, index, begin, len(data))
+		verified = self.download.store_piece(index,begin,data)
 		peer.received += len(data)
-		if self.download.have_piece(index):
-			self.notify_have(index)
-		self.live_requests -= 1
-		self.inprogress_requests.remove((index,begin))
-		self.send_request()
+		if verified is not None:
+			def announce(ok):
+				if ok:
+					self.notify_have(index)
+					for other in self.connected_peers:
+						# We may no longer need anything the peer has
+						if other.am_interested and index in other.bitfield:
+							self.update_interest(other)
+				elif self.endgame:
+					# The whole piece is wanted again, which may be too much
+					# to keep asking several peers for each block
+					self.endgame = False
+					self.start_endgame()
+				self.fill_pipelines()
+			verified.addCallback(announce)
+		self.fill_pipeline(peer)
 	
 	def notify_have(self,index):
-		for peer in self.connected_peers:
-			peer.connection.send_HAVE(index)
+		self.haves.add(index)
+
+	def send_bitfield(self, peer):
+		(pieces, held) = haves.lazy_bitfield(self.download.bitfield, self.lazy_bitfield)
+		peer.connection.send_BITFIELD(pieces)
+		if held:
+			peer.connection.send_HAVE(*held)
 
 	def get_pieces_to_request(self, peer):
-		my_pieces = self.download.bitfield
-		peer_bitfield = peer.bitfield
-		need_have = [~ord(mine) & ord(theirs) for (mine,theirs) in zip(my_pieces, peer_bitfield)]
-		can_request = [(idx,bits) for idx,bits in enumerate(need_have) if bits != 0]
-		for idx, bits in can_request:
-			offset = idx * 8
-			for bit in range(0,8):
-				if (1 << (7-bit)) & bits:
-					yield offset + bit
+		return iter(peer.bitfield.andnot(self.download.bitfield))
 
 	def get_pieces_to_send(self, peer):
-		my_pieces = self.download.bitfield
-		peer_bitfield = peer.bitfield
-		have_need = [ord(mine) & (~ord(theirs)) for (mine,theirs) in zip(my_pieces, peer_bitfield)]
-
-		can_send = [(idx,bits) for idx,bits in enumerate(have_need) if bits != 0]
+		return iter(self.download.bitfield.andnot(peer.bitfield))
 
-		for idx,bits in can_send:
-			offset = idx * 8
-			for bit in range(0,8):
-				if (1 << (7-bit)) & bits:
-					yield offset + bit
+	def check_data(self):
+		"""
+		Hash the data already on disk in the background, announcing the
+		pieces found as they are found. Returns a Deferred that fires with
+		the number found, or None if the check failed.
+		"""
+		def failed(failure):
+			self.logger.error("Checking existing data failed: %s", failure.getErrorMessage())
+			# What was found so far stands, but all of it is checked again
+			# next time rather than saved as resume data
+			self.download.needs_check = True
+		return self.download.check_progress_in_background(self.notify_have).addErrback(failed)
 
 	def start(self):
+		if self.download.needs_check:
+			self.check_data()
+
 		if not self.disable_announce:
 			self.logger.info("Announcing to tracker")
-			tracker_call = task.LoopingCall(self.ping_tracker)
-			tracker_call.start(300.0)
+			self.ping_tracker('started')
 		
 		peer_call = task.LoopingCall(self.check_peers)
 		peer_call.start(60.0) 
@@ -368,33 +578,72 @@ class Client():
 		
 		
 		task.LoopingCall(self.info).start(30)
-		
-		for request in range(10):
-			self.send_request()
-		
-		
 
-	
-	def ping_tracker(self):
-		announce = self.tracker_event()
-		self.handle_tracker_response(announce)
+		task.LoopingCall(self.download.save_resume).start(self.resume_interval, now=False)
+
+		task.LoopingCall(self.fill_pipelines).start(10.0)
+
+		# Time spent before starting, checking the data say, mustn't count
+		# against requests that have only just been made
+		self.request_timers.set_time(reactor.seconds())
+		task.LoopingCall(self.expire_requests).start(self.request_timers.resolution, now=False)
+
+	def stop(self):
+		"""
+		Write out everything we have downloaded, and the resume data for
+		it. Returns a Deferred that fires once the tracker has been told
+		we are stopping, if announcing.
+		"""
+		self.stopped = True
+		self.download.close()
+		self.haves.stop()
+		if self.tracker_call is not None and self.tracker_call.active():
+			self.tracker_call.cancel()
+		if self.disable_announce:
+			return None
+		d = self.tracker_event('stopped')
+		d.addErrback(lambda failure: None)
+		d.addCallback(lambda _: self.tracker.close())
+		return d
+
+	def ping_tracker(self, event=""):
+		"""
+		Announce to the tracker, and schedule the next announce for as long
+		as the tracker asks us to wait, or longer after failures. An event
+		such as 'started' is sent again until an announce gets through.
+		"""
+		def answered(response):
+			self.handle_tracker_response(response)
+			return ""
+		def failed(failure):
+			self.logger.warn("Announce failed: %s", failure.getErrorMessage())
+			return event
+		def schedule(next_event):
+			# An announce still in flight when we stopped
+			if self.stopped:
+				return
+			self.logger.info("Next announce in %d seconds", self.tracker.delay)
+			self.tracker_call = reactor.callLater(self.tracker.delay, self.ping_tracker, next_event)
+		d = self.tracker_event(event)
+		d.addCallback(answered)
+		d.addErrback(failed)
+		d.addCallback(schedule)
+		return d
 		
 	def info(self):
 		"""
 		Prints some information about the state of the client
 		"""
-		counts = {}
-		for (peer,piece,part) in self.requests:
-			counts[peer] = 0 if peer not in counts else counts[peer] + 1
-		
-		self.logger.info("Download %f%% (have %d pieces), %d connected clients, %d total peers, %d requests buffered, %d live requests, %d peers being requested, %r",
+		pipelines = dict(("%s:%d" % (peer.host, peer.port), (len(peer.pipeline), peer.pipeline.depth)) for peer in self.connected_peers if len(peer.pipeline))
+
+		self.logger.info("Download %f%% (have %d pieces), %d connected clients, %d total peers, %d live requests, %d peers being requested, outstanding/depth %r, read cache %r",
 		self.download.progress * 100, self.download.finished_pieces,
 		len(self.connected_peers),
 		len(self.peers),
-		len(self.requests),
-		self.live_requests,
-		len(counts.keys()),
-		counts
+		len(self.requested_parts),
+		len(pipelines),
+		pipelines,
+		self.download.read_cache
 		)
 	
 	def choke_peers(self):
@@ -402,91 +651,115 @@ class Client():
 		Decide which peers we want to send us something based on what
 		we know of them so far
 		"""
-		for peer in self.connected_peers:
-			peer.connection.send_UNCHOKE()
+		self.choker.rechoke(self.connected_peers, self.download.progress == 1, reactor.seconds())
 		
-	def fill_request_buffer(self):
+	def fill_pipelines(self):
+		for peer in self.connected_peers:
+			self.fill_pipeline(peer)
+
+	def fill_pipeline(self, peer):
 		"""
-		Buffer a large number of requests to send.
-		As soon as we receive responses we will use this list to request
-		more data to saturate the connection.
+		Top up the requests outstanding to a peer to its pipeline depth,
+		asking for blocks of the pieces the picker chooses that nobody else
+		has been asked for.
 		"""
-
-		if len(self.requests) > self.request_buffer_size:
+		if peer.choked or not peer.connection:
 			return
-		for peer in self.connected_peers:
-			if peer.choked:
+		# Don't ask for more while completed pieces are waiting to be hashed
+		if self.download.hash_queue.full:
+			return
+		room = peer.pipeline.room
+		if not room:
+			return
+		now = reactor.seconds()
+		for piece in self.picker.pick(peer.bitfield, self.download.pieces, self.download.piece_state):
+			for part in range(0,self.download.piece_size(piece),self.block_size):
+				length = min(self.block_size, self.download.piece_size(piece) - part)
+				if (piece,part) in self.requested_parts or self.download.have_piece_range(piece,part,length):
+					continue
+				self.request_block(peer,piece,part,length,now)
+				room -= 1
+				if not room:
+					return
+		if self.endgame or self.start_endgame():
+			self.fill_endgame(peer, room, now)
+
+	def request_block(self, peer, piece, part, length, now):
+		self.logger.debug("Requesting piece %d:%d from %s",piece,part,peer)
+		peer.connection.send_REQUEST(piece,part,length)
+		peer.pipeline.sent(piece,part,length,now)
+		self.requested_parts[(piece,part)] += 1
+		self.request_timers.add((peer,piece,part))
+
+	def forget_request(self, piece, part):
+		"""Count one fewer peer as asked for a block."""
+		asked = self.requested_parts.pop((piece,part), 0)
+		if asked > 1:
+			self.requested_parts[(piece,part)] = asked - 1
+
+	def start_endgame(self):
+		"""
+		Switch to endgame mode once fewer than endgame_blocks blocks are
+		left to download, returning whether we did.
+		"""
+		download = self.download
+		if download.torrent.info.num_pieces - download.finished_pieces > self.endgame_blocks:
+			return False
+		remaining = sum(1 for _ in itertools.islice(download.missing_blocks(self.block_size), self.endgame_blocks + 1))
+		if not remaining or remaining > self.endgame_blocks:
+			return False
+		self.logger.info("Entering endgame with %d blocks left", remaining)
+		self.endgame = True
+		return True
+
+	def fill_endgame(self, peer, room, now):
+		"""
+		Ask a peer for missing blocks that other peers have already been
+		asked for, up to endgame_peers requests for each block, so the last
+		blocks don't wait on one slow peer. Whichever copy arrives first
+		cancels the rest.
+		"""
+		for (piece, part, length) in self.download.missing_blocks(self.block_size):
+			if piece not in peer.bitfield or (piece,part) in peer.pipeline:
 				continue
-			pieces = self.get_pieces_to_request(peer)
-			chunks_requested = 0
-			for piece in pieces:
-				for part in range(0,self.download.piece_size(piece),2**14):
-					if not self.download.have_piece_range(piece,part,2**14):
-						if not (piece,part) in self.requested_parts and \
-							not (piece,part) in self.inprogress_requests:
-							chunks_requested += 1
-							self.requests.add((peer,piece,part))
-							self.requested_parts.add((piece,part))
-				if chunks_requested >= 10:
-					break
-	
-	def send_request(self):
-		"""
-		Make a request from the request buffer.
-		This function is re-entrant: a call to it starts a repeated
-		chain of callbacks to the function, via the handle_piece
-		method. Three things can happen:
-		1. There are no requests to make
-		2. The scheduled peer has disconnected
-		3. The peer is connected and the piece hasn't already been asked for
-		
+			if self.requested_parts[(piece,part)] >= self.endgame_peers:
+				continue
+			self.request_block(peer,piece,part,length,now)
+			room -= 1
+			if not room:
+				return
+
+	def cancel_duplicates(self, peer, index, begin, length):
+		"""Cancel the endgame requests to other peers for a block that has arrived."""
+		for other in self.connected_peers:
+			if other is not peer and other.pipeline.cancel(index, begin):
+				self.request_timers.cancel((other,index,begin))
+				other.connection.send_CANCEL(index, begin, length)
+
+	def expire_requests(self):
 		"""
-		# What we need here is to have
-		# several pieces per peer that we've asked for
-		# so each peer has a buffer and a chain of requests
-		# This method is responsible for keeping a live connection
-		# to a peer full.
-		
-		# It does this by:
-		# Asking for pieces to request as a list
-		# taking the first element of the list
-		# requesting it with a callback
-		# When a piece is requested it is removed from the request queue
-		# It sits on a waiting to hear back queue
-		# After a timeout it goes back on the main queue
-		# After a response it gets removed and doesn't go anywhere
-		
-		# Possible bugs:
-		# When the queue is being filled, a request might have been removed
-		# 
-		self.fill_request_buffer()
-		if self.requests:
-			valid_request = False
-			
-			while not valid_request and self.requests:
-				peer,piece,part = self.requests.pop()
-				valid_request = not self.download.have_piece_range(piece,part,2**14)
-			if peer.connection and valid_request:
-				peer.connection.send_UNCHOKE()
-				peer.connection.send_INTERESTED()
-				self.logger.debug("Requesting piece %d:%d from %s",piece,part,peer)
-				peer.connection.send_REQUEST(piece,part,2**14)
-				self.inprogress_requests.add((piece,part))
-				self.live_requests +=1 
-				def timeout_request():
-					if not self.download.have_piece_range(piece,part,2**14):
-						self.logger.debug("Request for piece %d:%d from %s timed out",piece,part,peer)
-						self.inprogress_requests.remove((piece,part))
-						self.requested_parts.remove((piece,part))
-						self.live_requests -= 1
-						self.send_request()
-				reactor.callLater(30, timeout_request)
-				
-			else:
-				reactor.callLater(10,self.send_request)
-		else:
-			reactor.callLater(10,self.send_request)
-		
+		Give up on every request that has gone unanswered for
+		request_timeout seconds and ask other peers for those blocks first,
+		before the peers that timed out get another go.
+		"""
+		slow = set()
+		for ((peer, piece, part), _) in self.request_timers.advance(reactor.seconds()):
+			if peer.pipeline.cancel(piece, part):
+				self.forget_request(piece, part)
+				slow.add(peer)
+		if not slow:
+			return
+		self.logger.debug("Requests timed out from %d peers", len(slow))
+		for peer in self.connected_peers:
+			if peer not in slow:
+				self.fill_pipeline(peer)
+		self.fill_pipelines()
+
+	def release_requests(self, peer):
+		"""Make the blocks outstanding to a peer available to others."""
+		for (piece, part) in peer.pipeline.clear():
+			self.forget_request(piece, part)
+			self.request_timers.cancel((peer,piece,part))
 
 	def get_needed(self):
 		return 0
@@ -506,25 +779,38 @@ class Client():
 		peer = self.get_peer(host=host, port=port, peer_id=peer_id)
 		if peer is None:
 			peer = Peer(host,port,peer_id,len(self.torrent.info.pieces))
-			self.peers.append(peer)
+			peer.bandwidth = ratelimit.Bandwidth(self.peer_upload_rate, self.peer_download_rate)
+			self.peers.add(peer)
 		if connection:
 			peer.connection = connection
-			self.connected_peers.append(peer)
+			self.peers.connect(peer)
 		if peer_id is not None and peer.peer_id is not None and (peer.peer_id != peer_id):
 			self.logger.warn("Peer %s has changed IDs to %s",repr(peer), repr(peer_id))
 		elif peer_id is not None and peer.peer_id is None:
-			peer.peer_id = peer_id
+			self.peers.set_peer_id(peer, peer_id)
 
 		return peer
 
+	def throttle(self, peer, transport, resume_uploads=None):
+		"""A Throttle holding a connection to its peer's, this torrent's and the global limits."""
+		scopes = (peer.bandwidth, self.bandwidth, self.global_bandwidth)
+		return ratelimit.Throttle(transport, [scope.download for scope in scopes], [scope.upload for scope in scopes], resume_uploads)
+
 	def get_peer(self, peer_id=None, host=None, port=None):
-		for peer in self.peers:
-			if (peer_id is not None and peer.peer_id == peer_id) or (peer.host == host and peer.port == port):
-				return peer
-		return None
+		return self.peers.get(peer_id, host, port)
+
+	def ban_peer(self, peer):
+		"""Never connect to a peer's address again, dropping it if connected."""
+		self.logger.info("Banning peer %s", peer)
+		self.peers.ban(peer)
+		if peer.connection:
+			peer.connection.disconnect()
 
 	def tracker_event(self, event=""):
-		tracker = self.torrent.announce
+		"""
+		Announce to the tracker, returning a Deferred that fires with its
+		response.
+		"""
 		params={\
 			'info_hash':self.torrent.info_hash, \
 			'peer_id':self.peer_id, \
@@ -543,10 +829,5 @@ class Client():
 		if event:
 			params['event'] = event
 
-		self.logger.info("Pinging tracker at %s with params %s", tracker,params)
-		response = requests.get(tracker,params=params)
-		if response.status_code != 200:
-			return None
-
-		result = bencode.bendecode(response.text)
-		return result
+		self.logger.info("Announcing to trackers %s with params %s", self.tracker.tiers, params)
+		return self.tracker.announce(params)
@@ -0,0 +1,63 @@
+import random
+
+from twisted.internet import reactor
+
+import bitfield
+
+class HaveBatcher(object):
+	"""
+	Announces the pieces we verify in batches rather than one HAVE at a
+	time. Pieces added within delay seconds of the first are sent together
+	in one write to each peer, and with suppress set a peer is not told of
+	pieces its bitfield shows it already has.
+
+	peers is called at each flush for the peers to announce to.
+	"""
+
+	def __init__(self, peers, delay=0.5, suppress=True, clock=reactor):
+		self.peers = peers
+		self.delay = delay
+		self.suppress = suppress
+		self.clock = clock
+		self.pending = []
+		self.call = None
+
+	def add(self, piece):
+		self.pending.append(piece)
+		if self.call is None:
+			self.call = self.clock.callLater(self.delay, self.flush)
+
+	def flush(self):
+		"""Send the pending pieces now."""
+		self.stop()
+		(pieces, self.pending) = (self.pending, [])
+		if not pieces:
+			return
+		for peer in list(self.peers()):
+			if peer.connection is None:
+				continue
+			if self.suppress:
+				wanted = [piece for piece in pieces if piece not in peer.bitfield]
+			else:
+				wanted = pieces
+			if wanted:
+				peer.connection.send_HAVE(*wanted)
+
+	def stop(self):
+		if self.call is not None and self.call.active():
+			self.call.cancel()
+		self.call = None
+
+def lazy_bitfield(pieces, count):
+	"""
+	Split the bitfield we send a new peer into one with up to count of
+	our pieces left out at random, and the list of those left out, to be
+	sent as HAVEs after it. Returns (bitfield, held back pieces).
+	"""
+	if not count:
+		return (pieces, [])
+	held = random.sample(list(pieces), min(count, len(pieces)))
+	sent = bitfield.Bitfield(pieces.length, pieces.bits)
+	for piece in held:
+		sent.discard(piece)
+	return (sent, sorted(held))
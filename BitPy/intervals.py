@@ -0,0 +1,64 @@
+import bisect
+
+class IntervalSet(object):
+	"""
+	The byte ranges received of a piece, kept as sorted, disjoint
+	[start, end) intervals with touching ones merged, so a piece
+	downloaded in order is a single interval. Adding a range and testing
+	whether one is covered are binary searches, and the number of bytes
+	covered is kept as ranges are added.
+
+	Iterating gives (start, end) tuples, and an IntervalSet compares equal
+	to a list of them.
+	"""
+	__slots__ = ('starts', 'ends', 'size')
+
+	def __init__(self, intervals=()):
+		self.starts = []
+		self.ends = []
+		self.size = 0
+		for (start, end) in intervals:
+			self.add(start, end)
+
+	def add(self, start, end):
+		"""Cover [start, end), returning the number of bytes newly covered."""
+		if end <= start:
+			return 0
+		# Intervals first to last overlap or touch the new one
+		first = bisect.bisect_left(self.ends, start)
+		last = bisect.bisect_right(self.starts, end)
+		if first == last:
+			self.starts.insert(first, start)
+			self.ends.insert(first, end)
+			self.size += end - start
+			return end - start
+		covered = sum(self.ends[i] - self.starts[i] for i in xrange(first, last))
+		start = min(start, self.starts[first])
+		end = max(end, self.ends[last - 1])
+		self.starts[first:last] = [start]
+		self.ends[first:last] = [end]
+		added = end - start - covered
+		self.size += added
+		return added
+
+	def covers(self, start, end):
+		"""Whether all of [start, end) has been added."""
+		if end <= start:
+			return True
+		i = bisect.bisect_right(self.starts, start) - 1
+		return i >= 0 and self.ends[i] >= end
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __iter__(self):
+		return iter(zip(self.starts, self.ends))
+
+	def __eq__(self, other):
+		return list(self) == list(other)
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return "IntervalSet(%r)" % (list(self),)
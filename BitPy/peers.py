@@ -0,0 +1,92 @@
+import collections
+
+class PeerRegistry(object):
+	"""
+	Every peer we know of for a torrent, indexed by (host, port) and by
+	peer id, along with which are connected, which are candidates to
+	connect to and which addresses are banned. Lookups, membership tests
+	and removal are all dictionary operations.
+
+	Candidates are known peers that aren't connected or banned; they are
+	handed out in rotation by next_candidates.
+	"""
+
+	def __init__(self):
+		self.by_address = {}
+		self.by_id = {}
+		self.connected = collections.OrderedDict()
+		self.candidates = collections.OrderedDict()
+		self.banned = set()
+
+	def __len__(self):
+		return len(self.by_address)
+
+	def __iter__(self):
+		return self.by_address.itervalues()
+
+	def __contains__(self, peer):
+		return (peer.host, peer.port) in self.by_address
+
+	def get(self, peer_id=None, host=None, port=None):
+		"""Find a peer by id, or failing that by address, or return None."""
+		if peer_id is not None:
+			peer = self.by_id.get(peer_id)
+			if peer is not None:
+				return peer
+		return self.by_address.get((host, port))
+
+	def add(self, peer):
+		address = (peer.host, peer.port)
+		self.by_address[address] = peer
+		if peer.peer_id is not None:
+			self.by_id[peer.peer_id] = peer
+		if address not in self.banned and peer not in self.connected:
+			self.candidates[peer] = None
+
+	def set_peer_id(self, peer, peer_id):
+		if peer.peer_id is not None and self.by_id.get(peer.peer_id) is peer:
+			del self.by_id[peer.peer_id]
+		peer.peer_id = peer_id
+		self.by_id[peer_id] = peer
+
+	def remove(self, peer):
+		self.by_address.pop((peer.host, peer.port), None)
+		if self.by_id.get(peer.peer_id) is peer:
+			del self.by_id[peer.peer_id]
+		self.connected.pop(peer, None)
+		self.candidates.pop(peer, None)
+
+	def connect(self, peer):
+		self.candidates.pop(peer, None)
+		self.connected[peer] = None
+
+	def disconnect(self, peer):
+		"""Mark a peer disconnected, returning False if it wasn't connected."""
+		if peer not in self.connected:
+			return False
+		del self.connected[peer]
+		if (peer.host, peer.port) not in self.banned:
+			self.candidates[peer] = None
+		return True
+
+	def is_connected(self, peer):
+		return peer in self.connected
+
+	def ban(self, peer):
+		self.banned.add((peer.host, peer.port))
+		self.candidates.pop(peer, None)
+
+	def is_banned(self, host, port):
+		return (host, port) in self.banned
+
+	def next_candidates(self, count):
+		"""
+		Return up to count candidates to connect to, moving each to the
+		back of the rotation.
+		"""
+		chosen = []
+		for _ in xrange(min(count, len(self.candidates))):
+			peer = self.candidates.popitem(last=False)[0]
+			self.candidates[peer] = None
+			chosen.append(peer)
+		return chosen
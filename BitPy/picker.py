@@ -0,0 +1,82 @@
+import array
+import itertools
+import random
+
+class PiecePicker(object):
+	"""
+	Tracks how many connected peers have each piece and hands out pieces
+	to request rarest first.
+
+	Pieces are kept in a list ordered by availability, along with where
+	each availability band starts, so a piece gaining or losing one peer
+	moves with a single swap to the edge of its band. Pieces with the
+	same availability are in random order, from an initial shuffle.
+	"""
+
+	def __init__(self, num_pieces):
+		self.order = range(num_pieces)
+		random.shuffle(self.order)
+		self.position = array.array('l', [0] * num_pieces)
+		for (position, piece) in enumerate(self.order):
+			self.position[piece] = position
+		self.availability = array.array('l', [0] * num_pieces)
+		# Pieces with availability a are order[starts[a]:starts[a+1]]
+		self.starts = [0, num_pieces]
+
+	def _swap(self, i, j):
+		order = self.order
+		(order[i], order[j]) = (order[j], order[i])
+		self.position[order[i]] = i
+		self.position[order[j]] = j
+
+	def increment(self, piece):
+		available = self.availability[piece]
+		if len(self.starts) < available + 3:
+			self.starts.append(len(self.order))
+		last = self.starts[available + 1] - 1
+		self._swap(self.position[piece], last)
+		self.starts[available + 1] -= 1
+		self.availability[piece] = available + 1
+
+	def decrement(self, piece):
+		available = self.availability[piece]
+		if available == 0:
+			return
+		first = self.starts[available]
+		self._swap(self.position[piece], first)
+		self.starts[available] += 1
+		self.availability[piece] = available - 1
+
+	def add_peer(self, bitfield):
+		for piece in bitfield:
+			self.increment(piece)
+
+	def remove_peer(self, bitfield):
+		for piece in bitfield:
+			self.decrement(piece)
+
+	def pick(self, peer_pieces, have, partial=()):
+		"""
+		Yield the pieces in peer_pieces that aren't in have: first any we
+		have partly downloaded, then the rest, rarest first.
+
+		The availability bands are walked lazily from the rarest, each from
+		a random point, so ties are broken afresh on every pick and a
+		caller that stops early only pays for the pieces it has looked at.
+		Pieces no peer has are never picked.
+		"""
+		started = [piece for piece in partial if piece in peer_pieces and piece not in have]
+		started.sort(key=self.availability.__getitem__)
+		for piece in started:
+			yield piece
+		order = self.order
+		starts = self.starts
+		for available in xrange(1, len(starts) - 1):
+			(first, end) = (starts[available], starts[available + 1])
+			if first == end:
+				continue
+			middle = random.randrange(first, end)
+			for position in itertools.chain(xrange(middle, end), xrange(first, middle)):
+				piece = order[position]
+				if piece in peer_pieces and piece not in have and piece not in partial:
+					yield piece
@@ -0,0 +1,77 @@
+import collections
+
+class Pipeline(object):
+	"""
+	The block requests outstanding to one peer.
+
+	Its depth follows the bandwidth-delay product of the connection: the
+	rate blocks arrive at times the shortest round trip seen for a request,
+	doubled for headroom. Until the first rate sample is in, the depth grows
+	by one block per block received, starting from min_depth.
+	"""
+
+	def __init__(self, min_depth=2, max_depth=250, block_size=2**14, rate_window=1.0):
+		self.min_depth = min_depth
+		self.max_depth = max_depth
+		self.block_size = block_size
+		self.rate_window = rate_window
+		self.outstanding = collections.OrderedDict()
+		self.rate = 0.0
+		self.min_rtt = None
+		self.window_start = None
+		self.window_bytes = 0
+		self.slow_start = min_depth
+
+	@property
+	def depth(self):
+		if not self.rate or self.min_rtt is None:
+			return min(self.slow_start, self.max_depth)
+		bdp = 2 * self.rate * self.min_rtt / self.block_size
+		return max(self.min_depth, min(self.max_depth, int(bdp) + self.min_depth))
+
+	@property
+	def room(self):
+		return max(self.depth - len(self.outstanding), 0)
+
+	def __len__(self):
+		return len(self.outstanding)
+
+	def __contains__(self, block):
+		return block in self.outstanding
+
+	def sent(self, piece, begin, length, now):
+		self.outstanding[(piece, begin)] = (length, now)
+		if self.window_start is None:
+			self.window_start = now
+
+	def received(self, piece, begin, length, now):
+		"""
+		Record a block arriving, returning False if it wasn't outstanding.
+		"""
+		request = self.outstanding.pop((piece, begin), None)
+		if request is None:
+			return False
+		rtt = now - request[1]
+		if self.min_rtt is None or rtt < self.min_rtt:
+			self.min_rtt = rtt
+		self.window_bytes += length
+		elapsed = now - self.window_start
+		if elapsed >= self.rate_window:
+			sample = self.window_bytes / elapsed
+			self.rate = sample if not self.rate else 0.7 * self.rate + 0.3 * sample
+			self.window_start = now
+			self.window_bytes = 0
+		elif not self.rate:
+			self.slow_start += 1
+		return True
+
+	def cancel(self, piece, begin):
+		return self.outstanding.pop((piece, begin), None) is not None
+
+	def clear(self):
+		"""Forget every outstanding request, returning their (piece, begin) keys."""
+		blocks = list(self.outstanding)
+		self.outstanding.clear()
+		self.window_start = None
+		self.window_bytes = 0
+		return blocks
@@ -1,5 +1,6 @@
-from twisted.protocols.basic import Int32StringReceiver
-from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
 import logging
 import struct
 
@@ -16,54 +17,163 @@ messages = {
 	9:'PORT'
 }
 
-
-class PeerConnection(Int32StringReceiver):
+# Length prefix, message id, index and begin of a PIECE message
+piece_header = struct.Struct('!IBII')
+
+# A whole HAVE message
+have_message = struct.Struct('!IBI')
+
+length_prefix = struct.Struct('!I')
+message_id = struct.Struct('!B')
+
+
+@implementer(IPushProducer)
+class UploadProducer(object):
+	"""
+	Sends the blocks a peer has queued with us. It is registered with the
+	transport as a streaming producer, and the transport pauses it while
+	its write buffer is full. It also waits while the connection's upload
+	limit is used up. So a block is only read from disk when it can go
+	straight out, and a peer can't make us buffer more than one block
+	past the transport's buffer size.
+	"""
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.paused = False
+		self.producing = False
+
+	def produce(self):
+		# Sending can pause us, or queue more blocks, from inside the loop
+		if self.producing:
+			return
+		self.producing = True
+		try:
+			connection = self.connection
+			peer = connection.peer
+			while peer.requests and not self.paused and not (connection.throttle and connection.throttle.uploads_blocked):
+				connection.client.handle_request(peer, peer.next_request())
+		finally:
+			self.producing = False
+
+	def pauseProducing(self):
+		self.paused = True
+
+	def resumeProducing(self):
+		self.paused = False
+		self.produce()
+
+	def stopProducing(self):
+		self.paused = True
+
+class PeerConnection(Protocol):
+	"""
+	A connection to a peer. After the handshake, messages are framed by
+	a 4 byte length prefix and parsed in place from what was received:
+	each is dispatched through handlers, indexed by message id, and given
+	a memoryview of its payload. Only the bytes of an incomplete message
+	are kept between reads, and trimming them off fails with BufferError
+	while a view is still held, so a handler that keeps a payload past
+	the call must copy it.
+	"""
 	logger = logging.getLogger('tcpserver')
+
+	# Longest message accepted: enough for a 128 KiB block, or the
+	# bitfield of a torrent of eight million pieces
+	max_length = 2**20
+
 	def __init__(self, client):
 		self.state = "HANDSHAKE"
-		self.preamble_size = 0
+		# Bytes received before the handshake is complete
+		self.handshake = bytearray()
+		# The start of a message split across reads
+		self.unprocessed = bytearray()
 		self.client = client
 		self.peer = None
+		self.throttle = None
+		# Message handlers indexed by message id, None for those we ignore
+		self.handlers = [getattr(self, 'handle_%s' % messages[message], None) if message in messages else None for message in range(256)]
+		self.uploader = None
 
 	def connectionMade(self):
 		self.send_HANDSHAKE()
 	
 	def connectionLost(self,reason):
+		if self.throttle:
+			self.throttle.stop()
 		if self.peer:
 			self.logger.debug("Lost connection from %s",self.peer)
 			self.client.disconnect_peer(self.peer)
 			self.peer.connection = None
 			
 	def disconnect(self):
+		self.state = "CLOSED"
 		self.transport.loseConnection()
 
 	def dataReceived(self, recd):
+		if self.throttle:
+			self.throttle.received(len(recd))
 		if self.state == "HANDSHAKE":
-			self.recvd = self.recvd + recd
-			#self.logger.debug("Received data in state %s: %s", self.state, repr(self.recvd))
-			if len(self.recvd) >= 1:
-				if self.preamble_size == 0:
-					pstrlen = ord(self.recvd[0])
-					self.preamble_size = pstrlen + 49
-				if len(self.recvd) >= self.preamble_size and self.preamble_size != 0:
-					preamble = self.recvd[0:self.preamble_size]
-					self.recvd = self.recvd[self.preamble_size:]
-					self.handle_HANDSHAKE(preamble)
-					self.state = "ACTIVE"
+			self.handshake.extend(recd)
+			preamble_size = self.handshake[0] + 49
+			if len(self.handshake) < preamble_size:
+				return
+			preamble = str(self.handshake[:preamble_size])
+			# Messages that came in the same chunk as the handshake
+			recd = str(self.handshake[preamble_size:])
+			self.handshake = None
+			self.handle_HANDSHAKE(preamble)
+			if self.peer is None:
+				self.state = "CLOSED"
+				return
+			if not recd:
+				return
+		elif self.state == "CLOSED":
+			return
+		if self.unprocessed:
+			data = self.unprocessed
+			data.extend(recd)
 		else:
-			Int32StringReceiver.dataReceived(self,recd)
-
-	def stringReceived(self, line):
-		#self.logger.debug("Received message %s", repr(line))
-		if line == "":
-			return self.handle_KEEPALIVE()
-		message_id = int(ord(line[0]))
-		if message_id not in messages:
-			self.logger.info("Unsupported message %d received from peer %s", message_id, self.transport.getPeer())
-		handler = getattr(self, "handle_%s"%messages[message_id])
-		return handler(line[1:])
-
+			# Parse straight out of what was read
+			data = recd
+		end = len(data)
+		offset = 0
+		handlers = self.handlers
+		view = memoryview(data)
+		while end - offset >= 4:
+			(length,) = length_prefix.unpack_from(data, offset)
+			if length > self.max_length:
+				self.lengthLimitExceeded(length)
+				return
+			start = offset + 4
+			if end - start < length:
+				break
+			offset = start + length
+			if not length:
+				self.handle_KEEPALIVE()
+				continue
+			(message,) = message_id.unpack_from(data, start)
+			handler = handlers[message]
+			if handler is None:
+				self.logger.info("Unsupported message %d received from peer %s", message, self.transport.getPeer())
+				continue
+			handler(view[start + 1:offset])
+			if self.state == "CLOSED" or self.peer is None:
+				# The handler dropped the peer; ignore whatever else it sent
+				return
+		if data is self.unprocessed:
+			del view
+			del data[:offset]
+		elif offset < end:
+			self.unprocessed = bytearray(view[offset:])
+
+	def lengthLimitExceeded(self, length):
+		self.logger.info("Dropping peer %s for sending a %d byte message", self.peer, length)
+		self.state = "CLOSED"
+		self.transport.loseConnection()
 
+	def sendString(self, message):
+		self.transport.write(length_prefix.pack(len(message)) + message)
 
 	def handle_KEEPALIVE(self):
 		pass
@@ -92,22 +202,30 @@ class PeerConnection(Int32StringReceiver):
 			repr(peer_id)\
 		)
 		self.info_hash = info_hash
-		self.peer = self.client.add_peer(self.transport.getPeer().host, self.transport.getPeer().port, peer_id, connection=self)
+		address = self.transport.getPeer()
+		if self.client.peers.is_banned(address.host, address.port):
+			self.logger.debug("Dropping banned peer %s", address)
+			self.disconnect()
+			return
+		self.peer = self.client.add_peer(address.host, address.port, peer_id, connection=self)
+		self.uploader = UploadProducer(self)
+		self.transport.registerProducer(self.uploader, True)
+		self.throttle = self.client.throttle(self.peer, self.transport, self.uploader.produce)
 		self.peer.choked = True
 		if self.client.download.progress != 0:
-			self.send_BITFIELD(self.client.download.bitfield)
+			self.client.send_bitfield(self.peer)
 
 		self.state="ACTIVE"
 
 	def handle_CHOKE(self,line):
-		self.peer.choked = True
+		self.client.handle_choke(self.peer)
 
 	def send_CHOKE(self):
 		self.sendString('\x00')
 
 	def handle_UNCHOKE(self,line):
 		self.logger.debug("Peer %s is unchoked"%self.peer)
-		self.peer.choked = False
+		self.client.handle_unchoke(self.peer)
 
 	def send_UNCHOKE(self):
 		self.sendString('\x01')
@@ -125,36 +243,48 @@ class PeerConnection(Int32StringReceiver):
 	def send_NOT_INTERESTED(self):
 		self.sendString('\x03')
 
-	def send_HAVE(self, piece):
-		self.sendString('\x04' + struct.pack('!I', piece))
+	def send_HAVE(self, *pieces):
+		"""Announce one or more pieces in a single write."""
+		self.transport.writeSequence([have_message.pack(5, 4, piece) for piece in pieces])
 
 	def handle_HAVE(self,line):
 		self.logger.debug("Got HAVE message from peer %s", self.peer)
 		index, = struct.unpack('!I', line)
-		self.peer.set_have(index)
+		self.client.handle_have(self.peer, index)
 
 	def handle_REQUEST(self,line):
-		self.peer.add_request(*struct.unpack('!3I',line))
+		if self.client.queue_request(self.peer, *struct.unpack('!3I',line)):
+			self.uploader.produce()
 
 	def send_REQUEST(self,piece,begin,length):
 		self.sendString('\x06' + struct.pack('!3I', piece,begin,length))
 
 	def handle_BITFIELD(self, line):
-		self.peer.set_bitfield(line)
+		self.client.handle_bitfield(self.peer, line)
 
-	def send_BITFIELD(self, bits):
-		self.sendString('\x05' + struct.pack('!%uc'%len(bits),*bits))
+	def send_BITFIELD(self, bitfield):
+		bits = bitfield.tobytes()
+		self.transport.writeSequence((struct.pack('!IB', 1 + len(bits), 5), bits))
 
 	def handle_PIECE(self,line):
-		index,begin = struct.unpack('!II',line[:8])
-		block = line[8:]
+		index,begin = struct.unpack_from('!II',line)
+		# The one copy of the block, out of the receive buffer
+		block = line[8:].tobytes()
 		self.client.handle_piece(self.peer,index,begin,block)
 
 	def send_PIECE(self, index, begin, block):
-		self.sendString('\x07' + struct.pack('!II', index,begin) + block)
-
-	def handle_CANCEL(self, index, begin, length):
-		pass
+		# Write the header and block as separate buffers rather than
+		# concatenating them, which would copy the whole block twice
+		header = piece_header.pack(9 + len(block), 7, index, begin)
+		self.transport.writeSequence((header, block))
+		if self.throttle:
+			self.throttle.sent(len(header) + len(block))
+
+	def handle_CANCEL(self, line):
+		self.client.handle_cancel(self.peer, *struct.unpack('!3I', line))
+
+	def send_CANCEL(self, piece, begin, length):
+		self.sendString('\x08' + struct.pack('!3I', piece, begin, length))
 
 class PeerClientFactory(Factory):
 	#TODO: notify client on disconnect
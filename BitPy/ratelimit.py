@@ -0,0 +1,147 @@
+from twisted.internet import reactor
+
+class TokenBucket(object):
+	"""
+	Allows rate bytes a second on average, in bursts of up to burst bytes.
+	A rate of None is unlimited; otherwise it must be positive. Spending more than there is puts the
+	bucket into debt, which delay says how long it takes to pay off.
+	"""
+
+	def __init__(self, rate=None, burst=None, clock=reactor):
+		self.clock = clock
+		self.rate = self._check_rate(rate)
+		self.burst = burst
+		self.tokens = self.capacity
+		self.updated = clock.seconds()
+
+	@property
+	def capacity(self):
+		if self.rate is None:
+			return 0
+		return self.burst if self.burst is not None else self.rate
+
+	@staticmethod
+	def _check_rate(rate):
+		# A rate of 0 would hold a connection paused for good
+		if rate is not None and rate <= 0:
+			raise ValueError("Rate must be positive, or None for unlimited")
+		return rate
+
+	def set_rate(self, rate, burst=None):
+		self._check_rate(rate)
+		self._refill()
+		self.rate = rate
+		self.burst = burst
+		self.tokens = min(self.tokens, self.capacity)
+
+	def _refill(self):
+		now = self.clock.seconds()
+		if self.rate is not None:
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def consume(self, amount):
+		if self.rate is None:
+			return
+		self._refill()
+		self.tokens -= amount
+
+	@property
+	def delay(self):
+		"""Seconds until the bucket is out of debt."""
+		if self.rate is None:
+			return 0
+		self._refill()
+		if self.tokens >= 0:
+			return 0
+		return -self.tokens / float(self.rate)
+
+class Bandwidth(object):
+	"""A pair of upload and download buckets, for one scope of limits."""
+
+	def __init__(self, upload_rate=None, download_rate=None, clock=reactor):
+		self.upload = TokenBucket(upload_rate, clock=clock)
+		self.download = TokenBucket(download_rate, clock=clock)
+
+# Shared by every torrent unless a client is given its own
+global_bandwidth = Bandwidth()
+
+class Throttle(object):
+	"""
+	Holds one connection to the limits of several buckets at once, such
+	as its peer's, its torrent's and the global ones.
+
+	Bytes received are charged to the download buckets, and while any is
+	in debt the transport stops reading, so the kernel's flow control
+	holds the data back rather than us buffering it. Bytes sent are
+	charged to the upload buckets, and while any is in debt
+	uploads_blocked is set; whatever produces uploads should check it and
+	wait for resume_uploads to be called. Without a resume_uploads
+	callback, reading stops instead, so no more requests come in.
+	"""
+
+	def __init__(self, transport, download=(), upload=(), resume_uploads=None, clock=reactor):
+		self.transport = transport
+		self.download = list(download)
+		self.upload = list(upload)
+		self.resume_uploads = resume_uploads
+		self.clock = clock
+		self.uploads_blocked = False
+		self.paused = set()
+		self.calls = {}
+
+	@staticmethod
+	def _delay(buckets):
+		return max([bucket.delay for bucket in buckets] or [0])
+
+	def received(self, amount):
+		for bucket in self.download:
+			bucket.consume(amount)
+		if 'download' not in self.paused:
+			self._hold('download', self.download)
+
+	def sent(self, amount):
+		for bucket in self.upload:
+			bucket.consume(amount)
+		if not self.uploads_blocked:
+			self._hold('upload', self.upload)
+
+	def _hold(self, reason, buckets):
+		delay = self._delay(buckets)
+		if not delay:
+			return
+		if reason == 'upload':
+			self.uploads_blocked = True
+		if reason == 'download' or self.resume_uploads is None:
+			self._pause_reading(reason)
+		self.calls[reason] = self.clock.callLater(delay, self._release, reason, buckets)
+
+	def _release(self, reason, buckets):
+		# Other connections may have spent the shared buckets meanwhile
+		delay = self._delay(buckets)
+		if delay:
+			self.calls[reason] = self.clock.callLater(delay, self._release, reason, buckets)
+			return
+		del self.calls[reason]
+		self._resume_reading(reason)
+		if reason == 'upload':
+			self.uploads_blocked = False
+			if self.resume_uploads is not None:
+				self.resume_uploads()
+
+	def _pause_reading(self, reason):
+		if not self.paused:
+			self.transport.pauseProducing()
+		self.paused.add(reason)
+
+	def _resume_reading(self, reason):
+		if reason in self.paused:
+			self.paused.discard(reason)
+			if not self.paused:
+				self.transport.resumeProducing()
+
+	def stop(self):
+		for call in self.calls.itervalues():
+			if call.active():
+				call.cancel()
+		self.calls.clear()
@@ -0,0 +1,66 @@
+import os
+
+import bencode
+import bitfield
+import intervals
+
+def file_stats(paths):
+	"""The [size, mtime in microseconds] of each file, or [-1, -1] if missing."""
+	stats = []
+	for path in paths:
+		try:
+			stat = os.stat(path)
+		except OSError:
+			stats.append([-1, -1])
+			continue
+		stats.append([stat.st_size, int(stat.st_mtime * 1000000)])
+	return stats
+
+def save(path, info_hash, pieces, piece_state, paths):
+	"""
+	Write fast-resume data: the completed pieces, the byte ranges we have
+	of incomplete ones and the size and mtime of every file. The data must
+	already be on disk. The file is replaced atomically.
+	"""
+	partial = [[index, [list(interval) for interval in state]] for (index, state) in sorted(piece_state.items()) if index not in pieces]
+	resume = {
+		'info hash': info_hash,
+		'pieces': pieces.bits,
+		'partial': partial,
+		'files': file_stats(paths),
+	}
+	temporary = path + '.tmp'
+	with open(temporary, 'wb') as resume_file:
+		bencode.encode_to(resume_file, resume)
+	os.rename(temporary, path)
+
+def load(path, info_hash, layout, paths):
+	"""
+	Read fast-resume data written by save. Returns None if there is none
+	or it doesn't belong to this torrent, otherwise a (pieces, piece_state,
+	recheck) tuple. Pieces touching any file whose size or mtime has
+	changed since are left out of pieces and piece_state and listed in
+	recheck instead.
+	"""
+	try:
+		with open(path, 'rb') as resume_file:
+			resume = bencode.bendecode(resume_file.read())
+		if resume['info hash'] != info_hash or len(resume['files']) != len(paths):
+			return None
+		pieces = bitfield.Bitfield(layout.num_pieces, resume['pieces'])
+		piece_state = dict((index, intervals.IntervalSet(state)) for (index, state) in resume['partial'])
+		saved_stats = resume['files']
+	except (IOError, ValueError, KeyError, TypeError):
+		return None
+
+	recheck = set()
+	for (index, (saved, current)) in enumerate(zip(saved_stats, file_stats(paths))):
+		length = int(layout.lengths[index])
+		if saved == current or length == 0:
+			continue
+		start = int(layout.offsets[index])
+		recheck.update(xrange(start // layout.piece_length, (start + length - 1) // layout.piece_length + 1))
+	for index in recheck:
+		pieces.discard(index)
+		piece_state.pop(index, None)
+	return (pieces, piece_state, sorted(recheck))
@@ -0,0 +1,332 @@
+import collections
+import logging
+import os
+
+class FilePool(object):
+	"""
+	A bounded pool of open file handles. When a file has to be opened and
+	the pool is full, the least recently used handle is closed.
+	"""
+
+	def __init__(self, max_open=128):
+		self.max_open = max_open
+		self.handles = collections.OrderedDict()
+
+	def get(self, path):
+		handle = self.handles.pop(path, None)
+		if handle is None:
+			if len(self.handles) >= self.max_open:
+				(_, oldest) = self.handles.popitem(last=False)
+				oldest.close()
+			handle = open(path, 'r+b')
+		self.handles[path] = handle
+		return handle
+
+	def discard(self, path):
+		handle = self.handles.pop(path, None)
+		if handle is not None:
+			handle.close()
+
+	def flush(self):
+		for handle in self.handles.itervalues():
+			handle.flush()
+
+	def close(self):
+		while self.handles:
+			(_, handle) = self.handles.popitem()
+			handle.close()
+
+def safe_path(components):
+	"""
+	Join the path components of a file in a torrent, refusing any that
+	would escape the download directory.
+	"""
+	for component in components:
+		if component in ('', '.', '..') or os.sep in component or \
+			(os.altsep and os.altsep in component):
+			raise ValueError("Unsafe path %r in torrent" % (components,))
+	return os.path.join(*components)
+
+class Storage(object):
+	"""
+	Reads and writes piece data across the files a torrent is made of,
+	using the torrent's layout to split each range at file boundaries.
+	"""
+	logger = logging.getLogger(__name__)
+
+	def __init__(self, info, directory='.', paths=None, pool=None):
+		self.info = info
+		self.pool = pool if pool is not None else FilePool()
+		if paths is None:
+			if info.filemode == 'single':
+				paths = [os.path.join(directory, safe_path(f['path'])) for f in info.files]
+			else:
+				root = os.path.join(directory, safe_path([info.name]))
+				paths = [os.path.join(root, safe_path(f['path'])) for f in info.files]
+		self.paths = paths
+
+	def allocate(self):
+		"""
+		Create any missing files and directories and give every file its
+		full length. Files are extended with truncate so the filesystem
+		can keep them sparse. Returns True if any file already had its full
+		length, meaning it may hold data worth checking.
+		"""
+		existing = False
+		for (path, f) in zip(self.paths, self.info.files):
+			length = f['length']
+			if os.path.exists(path) and os.path.getsize(path) == length:
+				existing = existing or length > 0
+				continue
+			directory = os.path.dirname(path)
+			if directory and not os.path.isdir(directory):
+				os.makedirs(directory)
+			self.logger.info("Allocating file %s (%d bytes)", path, length)
+			self.pool.discard(path)
+			with open(path, 'ab') as handle:
+				handle.truncate(length)
+		return existing
+
+	def read(self, piece, begin, length):
+		return self._read(self.info.layout.locate(piece, begin, length))
+
+	def read_range(self, offset, length):
+		"""Read length bytes at offset in the torrent's byte stream."""
+		return self._read(self.info.layout.locate_range(offset, length))
+
+	def _read(self, segments):
+		chunks = []
+		for (index, offset, size) in segments:
+			handle = self.pool.get(self.paths[index])
+			handle.seek(offset)
+			chunks.append(handle.read(size))
+		if len(chunks) == 1:
+			return chunks[0]
+		return "".join(chunks)
+
+	def write(self, piece, begin, data):
+		position = 0
+		for (index, offset, size) in self.info.layout.locate(piece, begin, len(data)):
+			handle = self.pool.get(self.paths[index])
+			handle.seek(offset)
+			handle.write(buffer(data, position, size))
+			position += size
+
+	def reopen(self):
+		"""
+		Return another Storage over the same files with its own handle
+		pool, for reading from a different thread.
+		"""
+		return Storage(self.info, paths=self.paths, pool=FilePool(self.pool.max_open))
+
+	def flush(self):
+		self.pool.flush()
+
+	def close(self):
+		self.pool.close()
+
+class FileStorage(object):
+	"""
+	Storage for a torrent kept in a single, already open file, with every
+	piece at its offset in the torrent's byte stream.
+	"""
+
+	def __init__(self, info, file):
+		self.info = info
+		self.file = file
+
+	def allocate(self):
+		return True
+
+	def read(self, piece, begin, length):
+		return self.read_range(piece * self.info.piece_length + begin, length)
+
+	def read_range(self, offset, length):
+		self.file.seek(offset)
+		return self.file.read(length)
+
+	def write(self, piece, begin, data):
+		self.file.seek(piece * self.info.piece_length + begin)
+		self.file.write(data)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+def contiguous_runs(blocks):
+	"""
+	Group a {begin: data} mapping of blocks into (begin, [data, ...]) runs
+	of blocks that follow each other with no gap.
+	"""
+	runs = []
+	end = None
+	for begin in sorted(blocks):
+		data = blocks[begin]
+		if begin == end:
+			runs[-1][1].append(data)
+		else:
+			runs.append((begin, [data]))
+		end = begin + len(data)
+	return runs
+
+class WriteCache(object):
+	"""
+	Write-back cache in front of a storage object. Blocks are held in
+	memory per piece until the piece is committed or flushed, and then
+	written out in as few writes as there are contiguous runs. Pieces whose
+	hash has checked out are marked verified. When the cache holds more
+	than max_bytes the least recently written verified piece is written out
+	early, and only if there is none is an unverified piece written out
+	before its hash has been checked. The underlying storage is flushed
+	after every flush_bytes written rather than after every block.
+	"""
+
+	def __init__(self, storage, max_bytes=32 * 2**20, flush_bytes=8 * 2**20):
+		self.storage = storage
+		self.max_bytes = max_bytes
+		self.flush_bytes = flush_bytes
+		self.pieces = collections.OrderedDict()
+		self.verified = set()
+		self.size = 0
+		self.unflushed = 0
+
+	def allocate(self):
+		return self.storage.allocate()
+
+	def write(self, piece, begin, data):
+		blocks = self.pieces.pop(piece, {})
+		if begin in blocks:
+			self.size -= len(blocks[begin])
+		blocks[begin] = data
+		self.pieces[piece] = blocks
+		self.size += len(data)
+		while self.size > self.max_bytes and self.pieces:
+			self.commit(self.eviction_candidate())
+
+	def eviction_candidate(self):
+		for piece in self.pieces:
+			if piece in self.verified:
+				return piece
+		return next(iter(self.pieces))
+
+	def read(self, piece, begin, length):
+		"""
+		Read from the cached blocks of piece, filling any gaps between them
+		from the underlying storage. Nothing is written out to do so.
+		"""
+		blocks = self.pieces.get(piece)
+		if not blocks:
+			return self.storage.read(piece, begin, length)
+		end = begin + length
+		position = begin
+		parts = []
+		for (run_begin, chunks) in contiguous_runs(blocks):
+			run = "".join(chunks)
+			if len(chunks) > 1:
+				# Keep the joined run so a later read or commit doesn't join it again
+				offset = run_begin
+				for chunk in chunks:
+					del blocks[offset]
+					offset += len(chunk)
+				blocks[run_begin] = run
+			run_end = run_begin + len(run)
+			if run_end <= position or run_begin >= end:
+				continue
+			if run_begin <= begin and end <= run_end:
+				if run_begin == begin and length == len(run):
+					return run
+				return run[begin - run_begin:end - run_begin]
+			if run_begin > position:
+				parts.append(self.storage.read(piece, position, run_begin - position))
+				position = run_begin
+			parts.append(run[position - run_begin:min(end, run_end) - run_begin])
+			position = min(end, run_end)
+		if position < end:
+			parts.append(self.storage.read(piece, position, end - position))
+		return "".join(parts)
+
+	def mark_verified(self, piece):
+		"""
+		Note that piece's hash has checked out, so its blocks are the first
+		to be written out when the cache is full.
+		"""
+		if piece in self.pieces:
+			self.verified.add(piece)
+
+	def commit(self, piece):
+		"""Write any cached blocks of piece to the underlying storage."""
+		self.verified.discard(piece)
+		blocks = self.pieces.pop(piece, None)
+		if not blocks:
+			return
+		for (begin, chunks) in contiguous_runs(blocks):
+			data = chunks[0] if len(chunks) == 1 else "".join(chunks)
+			self.storage.write(piece, begin, data)
+			self.size -= len(data)
+			self.unflushed += len(data)
+		if self.unflushed >= self.flush_bytes:
+			self.storage.flush()
+			self.unflushed = 0
+
+	def discard(self, piece):
+		"""Drop any cached blocks of piece without writing them."""
+		self.verified.discard(piece)
+		blocks = self.pieces.pop(piece, {})
+		self.size -= sum(len(data) for data in blocks.itervalues())
+
+	def flush(self):
+		for piece in list(self.pieces):
+			self.commit(piece)
+		self.storage.flush()
+		self.unflushed = 0
+
+	def close(self):
+		self.flush()
+		self.storage.close()
+
+class ReadCache(object):
+	"""
+	LRU cache of whole verified pieces, bounded by max_bytes, so blocks of
+	popular pieces can be served without going back to disk. Counts hits,
+	misses and evictions.
+	"""
+
+	def __init__(self, storage, max_bytes=64 * 2**20):
+		self.storage = storage
+		self.max_bytes = max_bytes
+		self.pieces = collections.OrderedDict()
+		self.size = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def add(self, piece, data):
+		if len(data) > self.max_bytes:
+			return
+		old = self.pieces.pop(piece, None)
+		if old is not None:
+			self.size -= len(old)
+		self.pieces[piece] = data
+		self.size += len(data)
+		while self.size > self.max_bytes:
+			(_, evicted) = self.pieces.popitem(last=False)
+			self.size -= len(evicted)
+			self.evictions += 1
+
+	def read(self, piece, begin, length, piece_size):
+		data = self.pieces.pop(piece, None)
+		if data is None:
+			self.misses += 1
+			data = self.storage.read(piece, 0, piece_size)
+			self.add(piece, data)
+		else:
+			self.hits += 1
+			self.pieces[piece] = data
+		if begin == 0 and length == len(data):
+			return data
+		return data[begin:begin + length]
+
+	def __repr__(self):
+		return repr({'pieces': len(self.pieces), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions})
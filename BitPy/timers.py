@@ -0,0 +1,64 @@
+class TimerWheel(object):
+	"""
+	Expires entries a fixed timeout after they are added, for timing out
+	many requests at once without a reactor call per request.
+
+	Entries go into a ring of slots, one per resolution seconds of the
+	timeout. Each tick of advance moves round the ring and expires the
+	whole slot it lands on, so entries expire between timeout and
+	timeout + resolution seconds after being added. Adding and cancelling
+	are O(1).
+	"""
+
+	def __init__(self, timeout, resolution=1.0, now=0.0):
+		self.timeout = timeout
+		self.resolution = resolution
+		# One extra slot so nothing expires before its full timeout
+		self.slots = [{} for _ in range(int(-(-timeout // resolution)) + 1)]
+		self.position = 0
+		self.last_tick = now
+		self.entries = {}
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def add(self, key, value=None):
+		"""Start the timeout for key, restarting it if key is already waiting."""
+		self.cancel(key)
+		self.slots[self.position][key] = value
+		self.entries[key] = self.position
+
+	def cancel(self, key):
+		"""Stop the timeout for key, returning False if it wasn't waiting."""
+		position = self.entries.pop(key, None)
+		if position is None:
+			return False
+		del self.slots[position][key]
+		return True
+
+	def set_time(self, now):
+		"""
+		Move the wheel's clock to now without expiring anything, for when
+		it hasn't been advanced since long before.
+		"""
+		self.last_tick = now
+
+	def advance(self, now):
+		"""Return a list of the (key, value) entries that have expired by now."""
+		ticks = int((now - self.last_tick) // self.resolution)
+		if ticks <= 0:
+			return []
+		self.last_tick += ticks * self.resolution
+		expired = []
+		for _ in xrange(min(ticks, len(self.slots))):
+			self.position = (self.position + 1) % len(self.slots)
+			slot = self.slots[self.position]
+			if slot:
+				for key in slot:
+					del self.entries[key]
+				expired.extend(slot.iteritems())
+				slot.clear()
+		return expired
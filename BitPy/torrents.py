@@ -1,25 +1,115 @@
 import bencode
 import hashlib
+import array
+import bisect
 
-class Info:
+class Pieces(object):
+	"""
+	Read-only sequence of the 20-byte SHA1 piece hashes, kept as the single
+	concatenated pieces string from the info dictionary rather than a list.
+	"""
+	__slots__ = ('data',)
+
+	def __init__(self, data):
+		if len(data) % 20 != 0:
+			raise ValueError("pieces length %d is not a multiple of 20" % len(data))
+		self.data = data
+
+	def __len__(self):
+		return len(self.data) // 20
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			(start, stop, step) = index.indices(len(self))
+			if step != 1:
+				return [self[i] for i in xrange(start, stop, step)]
+			return Pieces(buffer(self.data, start * 20, max(stop - start, 0) * 20))
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError("piece index out of range")
+		return self.data[index * 20:index * 20 + 20]
+
+	def __iter__(self):
+		for start in xrange(0, len(self.data), 20):
+			yield self.data[start:start + 20]
+
+# array has no 64-bit typecode on Python 2; 'L' is 64 bits on LP64 platforms,
+# elsewhere fall back to doubles, which are exact up to 2**53 bytes.
+_OFFSET_TYPE = 'L' if array.array('L').itemsize >= 8 else 'd'
+
+class Layout(object):
+	"""
+	Immutable index of how the torrent's files and pieces lie in the
+	concatenated byte stream they share.
+	"""
+	__slots__ = ('size', 'piece_length', 'num_pieces', 'last_piece_length', 'offsets', 'lengths')
+
+	def __init__(self, lengths, piece_length, num_pieces):
+		self.lengths = array.array(_OFFSET_TYPE, lengths)
+		self.offsets = array.array(_OFFSET_TYPE)
+		size = 0
+		for length in lengths:
+			self.offsets.append(size)
+			size += length
+		self.size = size
+		self.piece_length = piece_length
+		self.num_pieces = num_pieces
+		self.last_piece_length = size - (num_pieces - 1) * piece_length
+
+	def piece_size(self, index):
+		if index < self.num_pieces - 1:
+			return self.piece_length
+		return self.last_piece_length
+
+	def locate(self, piece, begin, length):
+		"""
+		Map length bytes at begin within piece to a list of
+		(file_index, file_offset, length) segments.
+		"""
+		if not 0 <= piece < self.num_pieces or begin < 0 or length < 0 or \
+			begin + length > self.piece_size(piece):
+			raise ValueError("Range %d:%d+%d is outside the torrent" % (piece, begin, length))
+		return self.locate_range(piece * self.piece_length + begin, length)
+
+	def locate_range(self, offset, length):
+		"""
+		Map length bytes at offset in the torrent's byte stream to a list
+		of (file_index, file_offset, length) segments.
+		"""
+		if offset < 0 or length < 0 or offset + length > self.size:
+			raise ValueError("Range %d+%d is outside the torrent" % (offset, length))
+		index = bisect.bisect_right(self.offsets, offset) - 1
+		segments = []
+		while length > 0:
+			file_offset = offset - int(self.offsets[index])
+			segment = min(length, int(self.lengths[index]) - file_offset)
+			if segment > 0:
+				segments.append((index, file_offset, segment))
+				offset += segment
+				length -= segment
+			index += 1
+		return segments
 
-	def __init__(self, info_struct):
-		self.piece_length = None
-		self.files = []
+class Info(object):
+
+	def __init__(self, info_struct, lazy=False):
 		self.private = info_struct.get('private',0)
 		self.piece_length = info_struct['piece length']
-		def chunk_values(str):
-			for start in xrange(0,len(str),20):
-				yield(str[start:start+20])
-		self.pieces = list(chunk_values(info_struct['pieces']))
+		self.pieces = Pieces(info_struct['pieces'])
+		if not lazy:
+			self.pieces = list(self.pieces)
 		self.name = info_struct['name']
 		if 'length' in info_struct:
 			self.filemode = 'single'
-			self.add_file([info_struct['name']], info_struct['length'],info_struct.get('md5sum',None))
+			self.files = [{'path':[info_struct['name']], 'length':info_struct['length'], 'md5sum':info_struct.get('md5sum',None)}]
 		else:
 			self.filemode = 'multiple'
-			for filestruct in info_struct['files']:
-				self.add_file(filestruct.path, filestruct.length, filestruct.get('md5sum',None))
+			self.files = [{'path':filestruct['path'], 'length':filestruct['length'], 'md5sum':filestruct.get('md5sum',None)} for filestruct in info_struct['files']]
+		self.layout = self.make_layout()
+
+	def make_layout(self):
+		return Layout([f['length'] for f in self.files], self.piece_length, len(self.pieces))
 
 	@property
 	def num_pieces(self):
@@ -27,11 +117,18 @@ class Info:
 
 	@property
 	def size(self):
-		return sum([f['length'] for f in self.files])
+		return self.layout.size
 
+	@size.setter
+	def size(self, value):
+		if len(self.files) != 1:
+			raise AttributeError("size can only be set for single file torrents")
+		self.files[0]['length'] = value
+		self.layout = self.make_layout()
 
 	def add_file(self, path, length, md5sum=None):
 		self.files.append({'path':path,'length':length,'md5sum':md5sum})
+		self.layout = self.make_layout()
 	
 	
 class TorrentFile:
@@ -43,7 +140,7 @@ class TorrentFile:
 	"""
 
 	
-	def __init__(self, torrent_file_contents={}):
+	def __init__(self, torrent_file_contents={}, info_hash=None, lazy=False):
 		self.info = None
 		self.announce = None
 		self.announce_list = None
@@ -55,17 +152,29 @@ class TorrentFile:
 			if k != 'info':
 				setattr(self,k.replace('-','_').replace(" ",'_'),v)
 			else:
-				self.info = Info(v)
+				self.info = Info(v, lazy)
 		
-		sha1 = hashlib.sha1()
-		sha1.update(bencode.bencode(torrent_file_contents['info']))
-		self.info_hash = sha1.digest()
+		if info_hash is None:
+			info_hash = hashlib.sha1(bencode.bencode(torrent_file_contents['info'])).digest()
+		self.info_hash = info_hash
 		
 	def __repr__(self):
 		return repr({"info":self.info, "announce":self.announce, "announce-list":self.announce_list, "creation date": self.creation_date, "comment":self.comment, "created by": self.created_by, "encoding": self.encoding, 'info hash': self.info_hash})
 
-def load_torrent_file(path):
-	with open(path) as torrentfile:
+def load_torrent_file(path, lazy=False):
+	"""
+	Load a .torrent file. With lazy set the piece hashes are kept as the
+	one string from the file behind a Pieces view, rather than split into
+	a list of 20-byte strings; the file itself is still read into memory.
+	"""
+	with open(path, 'rb') as torrentfile:
 		contents = torrentfile.read()
-		result = bencode.bendecode(contents)
-		return TorrentFile(result)
\ No newline at end of file
+	# Hash the info dictionary exactly as it appears in the file; re-encoding
+	# it would give the wrong hash for non-canonical torrents.
+	spans = {'info': None}
+	result = bencode.bendecode(contents, spans)
+	if spans['info'] is None:
+		raise ValueError("%s has no info dictionary" % path)
+	(start, end) = spans['info']
+	info_hash = hashlib.sha1(buffer(contents, start, end - start)).digest()
+	return TorrentFile(result, info_hash, lazy)
@@ -0,0 +1,115 @@
+import logging
+import random
+import urllib
+
+from twisted.internet import defer, reactor
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+
+import bencode
+
+class TrackerError(Exception):
+	pass
+
+class Tracker(object):
+	"""
+	Announces to a torrent's trackers through the reactor, so waiting on a
+	tracker never holds up peer traffic.
+
+	Trackers are grouped in tiers as in BEP 12: the trackers of each tier
+	are shuffled once and tried in order, tier by tier, until one answers,
+	and the one that answered moves to the front of its tier. Connections
+	are kept open between announces. After a failed announce the delay
+	before the next one backs off exponentially; otherwise it is the
+	interval the tracker asked for, never less than its min interval.
+	"""
+	logger = logging.getLogger(__name__)
+
+	def __init__(self, announce, announce_list=None, timeout=30, interval=300, retry_delay=15, max_backoff=3600, agent=None, clock=reactor):
+		if announce_list:
+			tiers = announce_list
+		else:
+			tiers = [[announce]]
+		# Leave out empty URLs; a torrent may have no trackers at all
+		self.tiers = [[url for url in tier if url] for tier in tiers]
+		self.tiers = [tier for tier in self.tiers if tier]
+		for tier in self.tiers:
+			random.shuffle(tier)
+		self.timeout = timeout
+		self.interval = interval
+		self.min_interval = None
+		self.retry_delay = retry_delay
+		self.max_backoff = max_backoff
+		self.failures = 0
+		self.clock = clock
+		self.pool = None
+		if agent is None:
+			self.pool = HTTPConnectionPool(clock)
+			agent = Agent(clock, connectTimeout=timeout, pool=self.pool)
+		self.agent = agent
+
+	@property
+	def delay(self):
+		"""Seconds to wait before the next announce."""
+		if self.failures:
+			return min(self.retry_delay * 2 ** (self.failures - 1), self.max_backoff)
+		return max(self.interval, self.min_interval or 0)
+
+	def announce(self, params):
+		"""
+		Announce to the first tracker that answers. Returns a Deferred that
+		fires with its decoded response, or fails with TrackerError if no
+		tracker did.
+		"""
+		if not self.tiers:
+			return defer.fail(TrackerError("No trackers"))
+		result = defer.Deferred()
+		attempts = iter([(tier, url) for tier in self.tiers for url in tier])
+		self._announce_next(attempts, params, result, [])
+		return result
+
+	def _announce_next(self, attempts, params, result, errors):
+		try:
+			(tier, url) = next(attempts)
+		except StopIteration:
+			self.failures += 1
+			result.errback(TrackerError("No tracker answered: %s" % "; ".join(errors)))
+			return
+		def answered(response):
+			tier.remove(url)
+			tier.insert(0, url)
+			self.failures = 0
+			self.interval = response.get('interval', self.interval)
+			self.min_interval = response.get('min interval', self.min_interval)
+			result.callback(response)
+		def failed(failure):
+			self.logger.info("Announce to %s failed: %s", url, failure.getErrorMessage())
+			errors.append("%s: %s" % (url, failure.getErrorMessage()))
+			self._announce_next(attempts, params, result, errors)
+		self.request(url, params).addCallbacks(answered, failed)
+
+	def request(self, url, params):
+		"""Send one announce, returning a Deferred that fires with the decoded response."""
+		if not url.startswith(('http://', 'https://')):
+			return defer.fail(TrackerError("Unsupported tracker %s" % url))
+		separator = '&' if '?' in url else '?'
+		d = self.agent.request('GET', url + separator + urllib.urlencode(params))
+		d.addCallback(self._read_response)
+		d.addTimeout(self.timeout, self.clock)
+		return d
+
+	def close(self):
+		"""Close the connections kept open to trackers, returning a Deferred."""
+		if self.pool is None:
+			return defer.succeed(None)
+		return self.pool.closeCachedConnections()
+
+	def _read_response(self, response):
+		def decode(body):
+			if response.code != 200:
+				raise TrackerError("HTTP status %d" % response.code)
+			result = bencode.bendecode(body)
+			if 'failure reason' in result:
+				raise TrackerError(result['failure reason'])
+			return result
+		# Read the body even on an error, so the connection can be reused
+		return readBody(response).addCallback(decode)
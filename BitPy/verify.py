@@ -0,0 +1,99 @@
+import collections
+import hashlib
+import multiprocessing
+
+from multiprocessing.pool import ThreadPool
+
+from twisted.internet import defer,threads
+
+def hash_pieces(data, sizes):
+	"""SHA1 each of the consecutive pieces of the given sizes in data."""
+	digests = []
+	offset = 0
+	for size in sizes:
+		digests.append(hashlib.sha1(buffer(data, offset, size)).digest())
+		offset += size
+	return digests
+
+def batches(layout, pieces, batch_bytes):
+	"""
+	Group piece indexes into runs of consecutive pieces holding up to
+	batch_bytes of data between them (and always at least one piece).
+	"""
+	batch = []
+	size = 0
+	for index in pieces:
+		piece_size = layout.piece_size(index)
+		if batch and (index != batch[-1] + 1 or size + piece_size > batch_bytes):
+			yield batch
+			batch = []
+			size = 0
+		batch.append(index)
+		size += piece_size
+	if batch:
+		yield batch
+
+def verify_pieces(storage, info, pieces=None, threads=None, batch_bytes=16 * 2**20):
+	"""
+	Check the data in storage against the piece hashes in info, yielding
+	(index, ok) for each piece as soon as its batch has been hashed.
+
+	Runs of consecutive pieces are read with one sequential read of about
+	batch_bytes each. The batches are hashed on a pool of threads while
+	the next ones are read; hashlib releases the GIL so the hashing runs
+	in parallel. No more than threads + 1 batches are held in memory.
+	"""
+	layout = info.layout
+	if pieces is None:
+		pieces = xrange(layout.num_pieces)
+	if threads is None:
+		threads = multiprocessing.cpu_count()
+	pool = ThreadPool(threads)
+	pending = collections.deque()
+
+	def results(batch, result):
+		for (index, digest) in zip(batch, result.get()):
+			yield (index, digest == info.pieces[index])
+
+	try:
+		for batch in batches(layout, pieces, batch_bytes):
+			sizes = [layout.piece_size(index) for index in batch]
+			data = storage.read_range(batch[0] * layout.piece_length, sum(sizes))
+			pending.append((batch, pool.apply_async(hash_pieces, (data, sizes))))
+			if len(pending) > threads:
+				for result in results(*pending.popleft()):
+					yield result
+		while pending:
+			for result in results(*pending.popleft()):
+				yield result
+	finally:
+		pool.terminate()
+
+def sha1_digest(data):
+	return hashlib.sha1(data).digest()
+
+class HashQueue(object):
+	"""
+	Hashes pieces with run, by default on the reactor's thread pool so the
+	reactor thread isn't held up, running at most max_jobs at once. More
+	jobs wait their turn; full is set once max_pending are outstanding,
+	so callers can hold off producing more.
+	"""
+
+	def __init__(self, max_jobs=2, max_pending=8, run=threads.deferToThread):
+		self.semaphore = defer.DeferredSemaphore(max_jobs)
+		self.max_pending = max_pending
+		self.pending = 0
+		self.run = run
+
+	@property
+	def full(self):
+		return self.pending >= self.max_pending
+
+	def sha1(self, data):
+		"""Returns a Deferred that fires with the SHA1 digest of data."""
+		self.pending += 1
+		def done(result):
+			self.pending -= 1
+			return result
+		return self.semaphore.run(self.run, sha1_digest, data).addBoth(done)
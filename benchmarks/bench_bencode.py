@@ -0,0 +1,65 @@
+"""
+Compare the remainder-copying bendecode_chunk decoder with the
+offset-based bendecode on synthetic metainfo.
+
+	python benchmarks/bench_bencode.py [--files N] [--pieces N]
+"""
+import os
+import sys
+import time
+import hashlib
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import BitPy.bencode
+
+def string(value):
+	return "%d:%s" % (len(value), value)
+
+def synthetic_metainfo(files, pieces):
+	piece_hashes = "".join(hashlib.sha1(str(i)).digest() for i in xrange(pieces))
+	info = ["d"]
+	if files:
+		info.append(string("files") + "l")
+		for i in xrange(files):
+			info.append("d" + string("length") + "i%de" % (1024 + i))
+			info.append(string("path") + "l" + string("dir%d" % (i % 100)) + string("file%d.bin" % i) + "ee")
+		info.append("e")
+	else:
+		info.append(string("length") + "i%de" % (pieces * 2**18))
+	info.append(string("name") + string("synthetic"))
+	info.append(string("piece length") + "i262144e")
+	info.append(string("pieces") + string(piece_hashes))
+	info.append("e")
+	return "d" + string("announce") + string("http://localhost:6969/announce") + string("info") + "".join(info) + "e"
+
+def best_of(repeat, fn, data):
+	best = None
+	for _ in range(repeat):
+		start = time.time()
+		fn(data)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best
+
+def main():
+	parser = OptionParser()
+	parser.add_option("--files", dest="files", type="int", default=10000)
+	parser.add_option("--pieces", dest="pieces", type="int", default=100000)
+	parser.add_option("--repeat", dest="repeat", type="int", default=3)
+	(options, args) = parser.parse_args()
+
+	cases = [
+		("%d files" % options.files, synthetic_metainfo(options.files, 64)),
+		("%d pieces" % options.pieces, synthetic_metainfo(0, options.pieces)),
+	]
+	for (name, data) in cases:
+		assert BitPy.bencode.bendecode(data) == BitPy.bencode.bendecode_chunk(data)[0]
+		old = best_of(options.repeat, BitPy.bencode.bendecode_chunk, data)
+		new = best_of(options.repeat, BitPy.bencode.bendecode, data)
+		print "%-14s %8d bytes  bendecode_chunk %8.3fs  bendecode %8.3fs  (%.1fx)" % (name, len(data), old, new, old / new)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,76 @@
+"""
+Time Client.fill_pipeline, which replaced fill_request_buffer, on a
+synthetic torrent with many partly downloaded pieces, so every candidate
+block is checked against the blocks already received.
+
+	python benchmarks/bench_fill_pipeline.py [--pieces N] [--partial N] [--depth N]
+"""
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import BitPy.bitfield
+import BitPy.client
+import BitPy.torrents
+
+class Connection(object):
+	def __init__(self):
+		self.requests = 0
+
+	def send_REQUEST(self, piece, begin, length):
+		self.requests += 1
+
+def synthetic_torrent(pieces, piece_length):
+	info = {
+		'name': 'synthetic',
+		'piece length': piece_length,
+		'length': pieces * piece_length,
+		'pieces': "".join(hashlib.sha1(str(i)).digest() for i in xrange(pieces)),
+	}
+	return BitPy.torrents.TorrentFile({'announce': 'http://localhost:6969/announce', 'info': info})
+
+def main():
+	parser = OptionParser()
+	parser.add_option("--pieces", dest="pieces", type="int", default=10000)
+	parser.add_option("--piece-length", dest="piece_length", type="int", default=2**20)
+	parser.add_option("--partial", dest="partial", type="int", default=2000)
+	parser.add_option("--depth", dest="depth", type="int", default=250)
+	parser.add_option("--repeat", dest="repeat", type="int", default=20)
+	(options, args) = parser.parse_args()
+
+	torrent = synthetic_torrent(options.pieces, options.piece_length)
+	client = BitPy.client.Client(torrent, file=tempfile.TemporaryFile())
+	download = client.download
+	# Every other block of the partial pieces is already here, and those
+	# pieces are tried first
+	for piece in xrange(options.partial):
+		for begin in xrange(0, options.piece_length, 2 * client.block_size):
+			download.store_piece(piece, begin, 'a' * client.block_size)
+
+	peer = BitPy.client.Peer('127.0.0.1', 6881, pieces=options.pieces)
+	peer.bitfield = BitPy.bitfield.Bitfield.full(options.pieces)
+	peer.connection = Connection()
+	peer.choked = False
+	peer.pipeline.slow_start = peer.pipeline.max_depth = options.depth
+	client.picker.add_peer(peer.bitfield)
+	client.peers.add(peer)
+	client.peers.connect(peer)
+
+	best = None
+	for _ in range(options.repeat):
+		client.release_requests(peer)
+		start = time.time()
+		client.fill_pipeline(peer)
+		elapsed = time.time() - start
+		best = elapsed if best is None else min(best, elapsed)
+	print "%d pieces, %d partial  %d requests  fill_pipeline %8.3fms  (%.1fus per request)" % (
+		options.pieces, options.partial, len(peer.pipeline), best * 1000, best * 1e6 / max(len(peer.pipeline), 1))
+
+if __name__ == '__main__':
+	main()
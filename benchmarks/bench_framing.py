@@ -0,0 +1,140 @@
+"""
+Compare the old Int32StringReceiver framing of peer messages, with its
+getattr dispatch and a copy of every payload, against PeerConnection's
+in-place framing and dispatch table, in messages a second received over
+loopback.
+
+	python benchmarks/bench_framing.py [--messages N] [--repeat N]
+"""
+import os
+import sys
+import time
+import struct
+
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import Int32StringReceiver
+
+import BitPy.client
+import BitPy.protocol
+
+class Client(object):
+	"""Stands in for the client, counting the messages it is handed."""
+
+	def __init__(self):
+		self.received = 0
+
+	def handle_have(self, peer, index):
+		self.received += 1
+
+	def handle_piece(self, peer, index, begin, block):
+		self.received += 1
+
+class OldConnection(Int32StringReceiver):
+	"""How PeerConnection framed and dispatched messages before."""
+	logger = BitPy.protocol.PeerConnection.logger
+	MAX_LENGTH = 2**20
+
+	def __init__(self, client):
+		self.client = client
+		self.peer = None
+
+	def stringReceived(self, line):
+		if line == "":
+			return
+		message_id = int(ord(line[0]))
+		handler = getattr(self, "handle_%s" % BitPy.protocol.messages[message_id])
+		return handler(line[1:])
+
+	handle_HAVE = BitPy.protocol.PeerConnection.handle_HAVE.im_func
+
+	def handle_PIECE(self, line):
+		index, begin = struct.unpack('!II', line[:8])
+		block = line[8:]
+		self.client.handle_piece(self.peer, index, begin, block)
+
+class NewConnection(BitPy.protocol.PeerConnection):
+	def connectionMade(self):
+		# Skip the handshake, as if it had been made with some peer
+		self.state = "ACTIVE"
+		self.peer = BitPy.client.Peer('127.0.0.1', 6881)
+
+class Receiver(protocol.Factory):
+	def __init__(self, connection, done):
+		self.connection = connection
+		self.done = done
+		self.client = Client()
+
+	def buildProtocol(self, addr):
+		receiver = self
+
+		class Timed(self.connection):
+			def connectionMade(self):
+				self.start = time.time()
+				receiver.connection.connectionMade(self)
+
+			def connectionLost(self, reason):
+				receiver.done.callback((receiver.client.received, time.time() - self.start))
+
+		return Timed(self.client)
+
+class Sender(protocol.Protocol):
+	def connectionMade(self):
+		self.transport.write(self.factory.stream)
+		self.transport.loseConnection()
+
+def message(payload):
+	return struct.pack('!I', len(payload)) + payload
+
+def stream(count, block_size):
+	if block_size:
+		piece = message('\x07' + struct.pack('!II', 0, 0) + 'x' * block_size)
+		return piece * count
+	return "".join(message('\x04' + struct.pack('!I', index)) for index in xrange(count))
+
+def receive(connection, data):
+	"""Send data over loopback to a receiver, firing with messages and seconds taken."""
+	done = defer.Deferred()
+	port = reactor.listenTCP(0, Receiver(connection, done), interface='127.0.0.1')
+	sender = protocol.ClientFactory()
+	sender.protocol = Sender
+	sender.stream = data
+	reactor.connectTCP('127.0.0.1', port.getHost().port, sender)
+	def stop(result):
+		return port.stopListening().addCallback(lambda _: result)
+	return done.addCallback(stop)
+
+@defer.inlineCallbacks
+def run(options):
+	cases = [
+		("HAVE", stream(options.messages, 0)),
+		("PIECE 16 KiB", stream(options.messages / 20, 2**14)),
+	]
+	for (name, data) in cases:
+		rates = []
+		for connection in (OldConnection, NewConnection):
+			best = None
+			for _ in range(options.repeat):
+				(received, elapsed) = yield receive(connection, data)
+				rate = received / elapsed
+				best = rate if best is None else max(best, rate)
+			rates.append(best)
+		(old, new) = rates
+		print "%-14s Int32StringReceiver %10.0f msg/s  PeerConnection %10.0f msg/s  (%.1fx)" % (name, old, new, new / old)
+
+def main():
+	parser = OptionParser()
+	parser.add_option("--messages", dest="messages", type="int", default=200000)
+	parser.add_option("--repeat", dest="repeat", type="int", default=3)
+	(options, args) = parser.parse_args()
+
+	d = run(options)
+	d.addErrback(lambda failure: failure.printTraceback())
+	d.addBoth(lambda _: reactor.stop())
+	reactor.run()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,24 @@
+"""Torrents built in memory for the tests."""
+import hashlib
+
+import BitPy.torrents
+
+def piece_hashes(data, piece_length):
+	return "".join(hashlib.sha1(data[start:start + piece_length]).digest() for start in range(0, len(data), piece_length))
+
+def make_torrent(data, piece_length, name='data.bin'):
+	"""A single file torrent of data."""
+	return BitPy.torrents.TorrentFile({'announce':'http://localhost/',
+		'info':{'name':name, 'length':len(data), 'piece length':piece_length, 'pieces':piece_hashes(data, piece_length)}})
+
+def make_multi_file_torrent(files, piece_length, name='dir'):
+	"""A torrent of the (name, contents) files given, in a directory."""
+	data = "".join(contents for (path, contents) in files)
+	return BitPy.torrents.TorrentFile({'announce':'http://localhost/',
+		'info':{'name':name, 'piece length':piece_length, 'pieces':piece_hashes(data, piece_length),
+			'files':[{'path':[path], 'length':len(contents)} for (path, contents) in files]}})
+
+def multi_file_info():
+	"""Four files, one empty and one in a subdirectory, over three pieces."""
+	return BitPy.torrents.Info({'name':'dir', 'piece length':10, 'pieces':'x'*20*3,
+		'files':[{'length':7, 'path':['a']}, {'length':0, 'path':['empty']}, {'length':16, 'path':['b','c']}, {'length':2, 'path':['d']}]})
@@ -1,4 +1,5 @@
 import BitPy.client
+import BitPy.ratelimit
 import BitPy.torrents
 
 import sys
@@ -26,12 +27,21 @@ parser.add_option("-P", "--add-peer-port",dest="port",
 				action="store",metavar="PORT")
 parser.add_option("-q", "--disable-announce",dest="quiet",
 				action="store_true", default=False)
+parser.add_option("--max-upload",dest="max_upload",
+				action="store", type="int", metavar="KB/S",
+				help="limit uploads to KB/S kilobytes a second")
+parser.add_option("--max-download",dest="max_download",
+				action="store", type="int", metavar="KB/S",
+				help="limit downloads to KB/S kilobytes a second")
 
 (options, args) = parser.parse_args()
 
 if not options.filename:
 	parser.print_help()
 	sys.exit(-1)
+for limit in (options.max_upload, options.max_download):
+	if limit is not None and limit <= 0:
+		parser.error("bandwidth limits must be positive")
 if options.debug:
 	logging.basicConfig(level=logging.DEBUG)
 else:
@@ -39,7 +49,18 @@ else:
 
 logging.getLogger(__name__).info("Loading file %s", options.filename)
 
-file = BitPy.torrents.load_torrent_file(options.filename)
+file = BitPy.torrents.load_torrent_file(options.filename, lazy=True)
+
+if options.verify:
+	download = BitPy.client.Download(file, check=False)
+	download.check_progress()
+	download.close()
+	sys.exit(0)
+
+if options.max_upload:
+	BitPy.ratelimit.global_bandwidth.upload.set_rate(options.max_upload * 1024)
+if options.max_download:
+	BitPy.ratelimit.global_bandwidth.download.set_rate(options.max_download * 1024)
 
 client = BitPy.client.Client(file)
 
@@ -49,9 +70,9 @@ if options.hostname and options.port:
 	logging.getLogger(__name__).info("Adding peer %s:%s", options.hostname,options.port)
 	client.add_peer(options.hostname,int(options.port))
 
-if not options.verify:
-	logging.getLogger(__name__).info("Starting download of %s", options.filename)
-	client.start()
-	client.listen_for_connections()
+logging.getLogger(__name__).info("Starting download of %s", options.filename)
+client.start()
+client.listen_for_connections()
+reactor.addSystemEventTrigger('before', 'shutdown', client.stop)
 
-	reactor.run()
+reactor.run()
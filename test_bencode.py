@@ -9,8 +9,12 @@ def test_bencode_string():
 def test_bencode_integer():
 	assert_equals(BitPy.bencode.bencode(50), "i50e")
 	
+def test_bencode_bool():
+	assert_equals(BitPy.bencode.bencode(True), "i1e")
+	assert_equals(BitPy.bencode.bencode({'a': False}), "d1:ai0ee")
+
 def test_bencode_list():
-	assert_equals(BitPy.bencode.bencode(['abc',5,['2'],[]]), "l43:abci5el11:2elee")
+	assert_equals(BitPy.bencode.bencode(['abc',5,['2'],[]]), "l3:abci5el1:2elee")
 	
 def test_bencode_dict():
 	assert_equals(BitPy.bencode.bencode({'abc':123,'def':{}}), 'd3:abci123e3:defdee')
@@ -44,4 +48,61 @@ def test_bendecode_torrent():
 @raises(Exception)
 def test_bendecode_invalid():
 	BitPy.bencode.bendecode("Xinvalid")
-	
\ No newline at end of file
+	
+def test_bendecode_negative_integer():
+	assert_equals(BitPy.bencode.bendecode("i-42e"), -42)
+
+def test_bendecode_at_returns_next_offset():
+	assert_equals(BitPy.bencode.bendecode_at("3:fooi7e", 5), (7, 8))
+
+def test_bendecode_buffers():
+	assert_equals(BitPy.bencode.bendecode(bytearray("d3:fool1:aee")), {'foo':['a']})
+	assert_equals(BitPy.bencode.bendecode(memoryview("d3:fool1:aee")), {'foo':['a']})
+
+def test_bendecode_truncated():
+	for truncated in ["4:foo", "i12", "li1e", "d3:foo", "d3:fooi1e", "12"]:
+		try:
+			BitPy.bencode.bendecode(truncated)
+		except BitPy.bencode.BencodeError as e:
+			assert_true(e.offset <= len(truncated))
+		else:
+			raise AssertionError("%r decoded without error" % truncated)
+
+@raises(BitPy.bencode.BencodeError)
+def test_bendecode_leading_zero():
+	BitPy.bencode.bendecode("i03e")
+
+@raises(BitPy.bencode.BencodeError)
+def test_bendecode_non_string_key():
+	BitPy.bencode.bendecode("di1ei2ee")
+
+@raises(BitPy.bencode.BencodeError)
+def test_bendecode_trailing_data():
+	BitPy.bencode.bendecode("i1ei2e")
+
+def test_bencode_round_trip():
+	value = {'announce':'http://localhost/', 'info':{'files':[{'length':1, 'path':['a','b']}], 'pieces':'x'*20}}
+	assert_equals(BitPy.bencode.bendecode(BitPy.bencode.bencode(value)), value)
+
+def test_bencode_into_appends():
+	buffer = bytearray("le")
+	assert_true(BitPy.bencode.bencode_into(buffer, [1]) is buffer)
+	assert_equals(str(buffer), "leli1ee")
+
+def test_encode_to_stream():
+	import StringIO
+	stream = StringIO.StringIO()
+	BitPy.bencode.encode_to(stream, {'a':[1,'b']})
+	assert_equals(stream.getvalue(), "d1:ali1e1:bee")
+
+@raises(TypeError)
+def test_bencode_unsupported():
+	BitPy.bencode.bencode(1.5)
+
+def test_bendecode_spans():
+	data = "d4:infod1:ai1ee4:spam3:egge"
+	spans = {'info': None, 'missing': None}
+	BitPy.bencode.bendecode(data, spans)
+	(start, end) = spans['info']
+	assert_equals(data[start:end], "d1:ai1ee")
+	assert_equals(spans['missing'], None)
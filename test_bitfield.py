@@ -0,0 +1,70 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import raises
+from BitPy.bitfield import Bitfield
+
+def test_add_and_contains():
+	bitfield = Bitfield(10)
+	bitfield.add(0)
+	bitfield.add(9)
+	bitfield.add(9)
+	assert_true(0 in bitfield)
+	assert_true(9 in bitfield)
+	assert_false(1 in bitfield)
+	assert_false(10 in bitfield)
+	assert_equals(len(bitfield), 2)
+	assert_equals(bitfield.tobytes(), '\x80\x40')
+
+def test_discard():
+	bitfield = Bitfield(10, '\xff\xc0')
+	bitfield.discard(3)
+	bitfield.discard(3)
+	assert_equals(len(bitfield), 9)
+	assert_equals(bitfield.tobytes(), '\xef\xc0')
+
+def test_spare_bits_cleared():
+	bitfield = Bitfield(10, '\xff\xff')
+	assert_equals(bitfield.tobytes(), '\xff\xc0')
+	assert_equals(len(bitfield), 10)
+
+def test_iterate():
+	assert_equals(list(Bitfield(20, '\x81\x00\x30')), [0, 7, 18, 19])
+	assert_equals(list(Bitfield(0)), [])
+
+def test_bulk_operations():
+	mine = Bitfield(12, '\xf0\x30')
+	theirs = Bitfield(12, '\x3c\x10')
+	assert_equals(list(mine & theirs), [2, 3, 11])
+	assert_equals(list(mine | theirs), [0, 1, 2, 3, 4, 5, 10, 11])
+	assert_equals(list(theirs.andnot(mine)), [4, 5])
+	assert_equals(mine.popcount(), 6)
+
+@raises(IndexError)
+def test_add_out_of_range():
+	Bitfield(3).add(3)
+
+@raises(ValueError)
+def test_wrong_length():
+	Bitfield(9, '\x00')
+
+@raises(ValueError)
+def test_mismatched_lengths():
+	Bitfield(8) & Bitfield(16)
+
+def test_full():
+	bitfield = Bitfield.full(10)
+	assert_equals(list(bitfield), range(10))
+	assert_equals(bitfield.tobytes(), '\xff\xc0')
+
+def test_count_after_bulk_operation():
+	mine = Bitfield(12, '\xf0\x10')
+	theirs = Bitfield(12, '\x3c\x30')
+	missing = theirs.andnot(mine)
+	assert_true(missing)
+	missing.add(0)
+	missing.discard(5)
+	assert_equals(len(missing), 3)
+	assert_equals(list(missing), [0, 4, 10])
+	assert_false(mine.andnot(mine))
+	assert_false(Bitfield(12, '\x00\x00'))
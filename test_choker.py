@@ -0,0 +1,94 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from BitPy.choker import Choker, RateMeter
+from BitPy.client import Peer
+
+class Connection(object):
+	def __init__(self):
+		self.sent = []
+
+	def send_CHOKE(self):
+		self.sent.append('CHOKE')
+
+	def send_UNCHOKE(self):
+		self.sent.append('UNCHOKE')
+
+def connected_peers(count):
+	peers = []
+	for port in range(count):
+		peer = Peer('10.0.0.1', 6881 + port)
+		peer.connection = Connection()
+		peer.interested = True
+		peers.append(peer)
+	return peers
+
+def test_rate_meter():
+	meter = RateMeter(window=20)
+	assert_equals(meter.rate, 0)
+	for second in range(0, 60, 10):
+		meter.update(second * 1000, second)
+	assert_equals(meter.rate, 1000)
+	# Only the last window counts
+	meter.update(50000 + 10 * 5000, 60)
+	assert_true(len(meter.samples) <= 3)
+	assert_equals(meter.rate, (100000 - 40000) / 20.0)
+
+def test_fastest_peers_are_unchoked():
+	peers = connected_peers(6)
+	choker = Choker(upload_slots=3)
+	choker.rechoke(peers, False, 0)
+	for (rate, peer) in enumerate(peers):
+		peer.received = rate * 1000
+	choker.rechoke(peers, False, 10)
+	unchoked = [peer for peer in peers if not peer.am_choking]
+	assert_equals(len(unchoked), 3)
+	# The two fastest, and one optimistic unchoke
+	assert_true(peers[5] in unchoked and peers[4] in unchoked)
+	assert_true(choker.optimistic in unchoked)
+
+def test_seeding_ranks_by_upload():
+	peers = connected_peers(4)
+	choker = Choker(upload_slots=2)
+	choker.rechoke(peers, True, 0)
+	peers[2].sent = 10000
+	peers[3].received = 50000
+	choker.rechoke(peers, True, 10)
+	assert_false(peers[2].am_choking)
+
+def test_uninterested_peers_stay_choked():
+	peers = connected_peers(3)
+	peers[0].interested = False
+	Choker(upload_slots=4).rechoke(peers, False, 0)
+	assert_true(peers[0].am_choking)
+	assert_equals(peers[0].connection.sent, [])
+
+def test_messages_only_sent_on_transitions():
+	peers = connected_peers(2)
+	choker = Choker(upload_slots=4)
+	choker.rechoke(peers, False, 0)
+	choker.rechoke(peers, False, 10)
+	assert_equals(peers[0].connection.sent, ['UNCHOKE'])
+	peers[0].interested = False
+	peers[0].add_request(0, 0, 10, 1)
+	choker.rechoke(peers, False, 20)
+	assert_equals(peers[0].connection.sent, ['UNCHOKE', 'CHOKE'])
+	assert_equals(len(peers[0].requests), 0)
+
+def test_optimistic_unchoke_rotates():
+	peers = connected_peers(10)
+	choker = Choker(upload_slots=2, optimistic_rounds=3)
+	chosen = set()
+	for round in range(30):
+		choker.rechoke(peers, False, round * 10)
+		chosen.add(choker.optimistic)
+		assert_equals(len([peer for peer in peers if not peer.am_choking]), 2)
+	assert_true(len(chosen) > 1)
+
+def test_removed_peer_is_not_optimistic():
+	peers = connected_peers(1)
+	choker = Choker(upload_slots=1)
+	choker.rechoke(peers, False, 0)
+	assert_true(choker.optimistic is peers[0])
+	choker.remove(peers[0])
+	assert_equals(choker.optimistic, None)
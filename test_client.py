@@ -3,6 +3,7 @@ from nose.twistedtools import reactor, deferred
 import nose.twistedtools
 import BitPy.client
 import BitPy.torrents
+import BitPy.tracker
 import logging
 
 import binhex
@@ -22,6 +23,9 @@ import hashlib
 
 import tempfile
 
+from fixtures import make_torrent
+from test_tracker import FakeTracker, finish
+
 sha1 = hashlib.sha1()
 sha1.update('a'*10)
 sha1_10_as = sha1.digest()
@@ -37,10 +41,42 @@ class TestTracker():
 	def test_client_generates_peer_id(self):
 		assert_equals(len(self.client.peer_id), 20)
 
+	@deferred(timeout=5)
 	def test_client_pings_tracker(self):
-		res = self.client.tracker_event()
-		assert_true('failure reason' not in res)
-		assert_true('warning message' not in res)
+		fake = FakeTracker({'interval': 600, 'peers': '\x7f\x00\x00\x01\x1a\xe1'}).listen()
+		self.client.tracker = BitPy.tracker.Tracker(fake.url, timeout=2)
+		def check(_):
+			assert_equals(fake.announces[0]['info_hash'], [self.torrent.info_hash])
+			assert_equals(fake.announces[0]['event'], ['started'])
+			assert_true(self.client.get_peer(host='127.0.0.1', port=6881) is not None)
+			# The next announce is when the tracker asked for it
+			assert_true(self.client.tracker_call.active())
+			assert_true(599 < self.client.tracker_call.getTime() - reactor.seconds() <= 600)
+			# The tracker has heard we started
+			assert_equals(self.client.tracker_call.args, ('',))
+			self.client.tracker_call.cancel()
+		d = self.client.ping_tracker('started').addCallback(check)
+		return finish(d, self.client.tracker, fake)
+
+	def test_started_sent_again_after_failure(self):
+		# A torrent without trackers fails without raising
+		self.client.tracker = BitPy.tracker.Tracker(None)
+		self.client.ping_tracker('started')
+		assert_equals(self.client.tracker_call.args, ('started',))
+		self.client.tracker_call.cancel()
+
+	@deferred(timeout=5)
+	def test_stop_during_announce(self):
+		fake = FakeTracker().listen()
+		self.client.tracker = BitPy.tracker.Tracker(fake.url, timeout=2)
+		started = self.client.ping_tracker('started')
+		stopped = self.client.stop()
+		def check(_):
+			assert_equals(sorted(announce['event'][0] for announce in fake.announces), ['started', 'stopped'])
+			# No announce is scheduled after stopping
+			assert_equals(self.client.tracker_call, None)
+		d = defer.gatherResults([started, stopped]).addCallback(check)
+		return finish(d, self.client.tracker, fake)
 
 	def test_client_updates_tracker_id(self):
 		self.client.handle_tracker_response({'tracker id':'dead beef face', 'info hash':self.torrent.info_hash})
@@ -65,44 +101,51 @@ class TestClientBeaviour(unittest.TestCase):
 		assert_true(mock.called)
 
 
+class TestCheckData():
+	def setUp(self):
+		self.torrent = make_torrent('a' * 30, 10)
+		self.client = BitPy.client.Client(self.torrent, file=tempfile.SpooledTemporaryFile())
+
+	@deferred(timeout=5)
+	def test_failed_check_needs_recheck(self):
+		download = self.client.download
+		download.storage.storage.reopen = mock.Mock(side_effect=IOError("gone"))
+		def check(result):
+			assert_equals(result, None)
+			assert_false(download.checking)
+			assert_true(download.needs_check)
+		return self.client.check_data().addCallback(check)
 
 class TestDownload(unittest.TestCase):
-	def setUp(self):
-		self.torrent = get_torrent()
+	def start(self, data, piece_length=10):
+		self.torrent = make_torrent(data, piece_length)
 		self.download = BitPy.client.Download(self.torrent,file=tempfile.SpooledTemporaryFile())
-		self.torrent.info.piece_length = 50
 
 	def test_empty_progress(self):
+		self.start('a'*100, 50)
 		assert_equals(self.download.piece_progress(0), 0)
 
 	def test_full_progress_from_multiple_pieces(self):
+		self.start('a'*10)
 		self.download.store_piece(0,0,'a')
-		self.torrent.info.piece_length=10
-		self.torrent.info.pieces = [sha1_10_as]
-		self.torrent.info.size=10
 		assert_equals(self.download.piece_progress(0), .1)
 		self.download.store_piece(0,1,'a' * 9)
 		assert_equals(self.download.piece_progress(0), 1)
 
 	def test_bitfield(self):
-		self.torrent.info.pieces = [sha1_10_as for _ in range(2)]
-		self.torrent.info.piece_length=10
-		assert_equals(self.download.bitfield,['\x00'])
+		self.start('a'*20)
+		assert_equals(self.download.bitfield.tobytes(),'\x00')
 		self.download.store_piece(0,0,'a'*10)
-		assert_equals(self.download.bitfield, [chr(0b10000000)])
+		assert_equals(self.download.bitfield.tobytes(), chr(0b10000000))
 
 	def test_verify_piece(self):
-		self.torrent.info.pieces = [sha1_10_as]
-		self.torrent.info.piece_length = 10
-		self.torrent.info.size=10
+		self.start('a'*10)
 		assert_false(self.download.have_piece(0))
 		self.download.store_piece(0,0,'a'*10)
 		assert_true(self.download.have_piece(0))
 
 	def test_progress(self):
-		self.torrent.info.pieces = [sha1_10_as for _ in range(2)]
-		self.torrent.info.piece_length=10
-		self.torrent.info.size = 20
+		self.start('a'*20)
 		assert_equals(self.download.progress,0)
 		self.download.store_piece(0,0,'a'*10)
 		assert_equals(self.download.piece_progress(0),1.0)
@@ -112,22 +155,17 @@ class TestDownload(unittest.TestCase):
 		assert_equals(self.download.progress,1)
 
 	def test_missing_pieces(self):
-		self.torrent.info.pieces = [sha1_10_as for _ in range(0,3)]
-		self.torrent.info.piece_length=10
+		self.start('a'*30)
 		assert_equals(self.download.missing_pieces, [0,1,2])
 		self.download.store_piece(0,0,'a'*10)
 		assert_equals(self.download.missing_pieces, [1,2])
 	
 	def test_piece_size(self):
-		self.torrent.info.pieces = [sha1_10_as]
-		self.torrent.info.piece_length = 10
-		self.torrent.info.size = 10
+		self.start('a'*10)
 		assert_equals(self.download.piece_size(0), 10)
 		
 	def test_two_piece_size(self):
-		self.torrent.info.pieces = [sha1_10_as,sha1_10_as]
-		self.torrent.info.piece_length = 10
-		self.torrent.info.size = 20
+		self.start('a'*20)
 		assert_equals(self.download.piece_size(0), 10)
 		assert_equals(self.download.piece_size(1), 10)
 
@@ -143,7 +181,7 @@ class TestRemote():
 		client.connect_peer(peer)
 		d = defer.Deferred()
 		def check_bitfield(d):
-			assert_true(any([x>0 for x in peer.bitfield]))
+			assert_true(len(peer.bitfield) > 0)
 		reactor.callLater(10, d.callback,'f')
 		d.addCallback(check_bitfield)
 		return d
@@ -0,0 +1,69 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from twisted.internet import task
+from BitPy.bitfield import Bitfield
+from BitPy.client import Peer
+from BitPy.haves import HaveBatcher, lazy_bitfield
+
+class Connection(object):
+	def __init__(self):
+		self.sent = []
+
+	def send_HAVE(self, *pieces):
+		self.sent.append(pieces)
+
+def connected_peer(port, pieces=()):
+	peer = Peer('10.0.0.1', port, pieces=8)
+	peer.connection = Connection()
+	for piece in pieces:
+		peer.set_have(piece)
+	return peer
+
+def test_haves_sent_together():
+	clock = task.Clock()
+	peers = [connected_peer(6881), connected_peer(6882)]
+	batcher = HaveBatcher(lambda: peers, delay=0.5, clock=clock)
+	batcher.add(3)
+	clock.advance(0.25)
+	batcher.add(5)
+	assert_equals(peers[0].connection.sent, [])
+	clock.advance(0.25)
+	for peer in peers:
+		assert_equals(peer.connection.sent, [(3, 5)])
+	# A later piece starts a new batch
+	batcher.add(6)
+	clock.advance(0.5)
+	assert_equals(peers[0].connection.sent, [(3, 5), (6,)])
+
+def test_peers_not_told_of_pieces_they_have():
+	clock = task.Clock()
+	peers = [connected_peer(6881, [3]), connected_peer(6882, [3, 5])]
+	batcher = HaveBatcher(lambda: peers, clock=clock)
+	batcher.add(3)
+	batcher.add(5)
+	batcher.flush()
+	assert_equals(peers[0].connection.sent, [(5,)])
+	assert_equals(peers[1].connection.sent, [])
+	assert_equals(clock.getDelayedCalls(), [])
+
+def test_without_suppression_every_peer_is_told():
+	peers = [connected_peer(6881, [3])]
+	batcher = HaveBatcher(lambda: peers, suppress=False, clock=task.Clock())
+	batcher.add(3)
+	batcher.flush()
+	assert_equals(peers[0].connection.sent, [(3,)])
+
+def test_lazy_bitfield():
+	pieces = Bitfield.full(20)
+	(sent, held) = lazy_bitfield(pieces, 4)
+	assert_equals(len(held), 4)
+	assert_equals(len(sent), 16)
+	assert_true(all(piece not in sent for piece in held))
+	# What we have is left alone
+	assert_equals(len(pieces), 20)
+
+def test_lazy_bitfield_off():
+	pieces = Bitfield.full(20)
+	assert_equals(lazy_bitfield(pieces, 0), (pieces, []))
+	# Never more held back than we have
+	assert_equals(lazy_bitfield(Bitfield.from_int(8, 0x81), 4)[1], [0, 7])
@@ -0,0 +1,36 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from BitPy.intervals import IntervalSet
+
+def test_add_merges_touching_intervals():
+	state = IntervalSet()
+	assert_equals(state.add(0, 1), 1)
+	assert_equals(state.add(2, 3), 1)
+	assert_equals(state, [(0, 1), (2, 3)])
+	assert_equals(state.add(1, 2), 1)
+	assert_equals(state, [(0, 3)])
+	assert_equals(state.size, 3)
+
+def test_overlapping_adds_count_new_bytes_only():
+	state = IntervalSet([(10, 20), (30, 40)])
+	assert_equals(state.add(15, 35), 10)
+	assert_equals(state, [(10, 40)])
+	assert_equals(state.add(0, 50), 20)
+	assert_equals(state.add(20, 30), 0)
+	assert_equals(state.size, 50)
+
+def test_out_of_order_adds():
+	state = IntervalSet()
+	for begin in (48, 0, 32, 16):
+		state.add(begin, begin + 16)
+	assert_equals(list(state), [(0, 64)])
+
+def test_covers():
+	state = IntervalSet([(0, 16), (32, 48)])
+	assert_true(state.covers(0, 16))
+	assert_true(state.covers(36, 40))
+	assert_false(state.covers(8, 24))
+	assert_false(state.covers(16, 32))
+	assert_false(state.covers(40, 64))
+	assert_true(state.covers(20, 20))
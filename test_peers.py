@@ -0,0 +1,56 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from BitPy.client import Peer
+from BitPy.peers import PeerRegistry
+
+def registry(count):
+	peers = PeerRegistry()
+	for port in range(count):
+		peers.add(Peer('10.0.0.1', 6881 + port))
+	return peers
+
+def test_get_by_address_and_id():
+	peers = registry(3)
+	peer = peers.get(host='10.0.0.1', port=6882)
+	assert_equals(peer.port, 6882)
+	peers.set_peer_id(peer, 'A' * 20)
+	assert_true(peers.get('A' * 20) is peer)
+	assert_true(peers.get('A' * 20, '10.0.0.1', 6881) is peer)
+	assert_equals(peers.get(host='10.0.0.2', port=6881), None)
+	assert_equals(len(peers), 3)
+
+def test_connect_and_disconnect():
+	peers = registry(3)
+	peer = peers.get(host='10.0.0.1', port=6881)
+	peers.connect(peer)
+	assert_true(peers.is_connected(peer))
+	assert_equals(len(peers.candidates), 2)
+	assert_true(peers.disconnect(peer))
+	assert_false(peers.disconnect(peer))
+	assert_equals(len(peers.candidates), 3)
+
+def test_candidates_rotate():
+	peers = registry(3)
+	assert_equals([peer.port for peer in peers.next_candidates(2)], [6881, 6882])
+	assert_equals([peer.port for peer in peers.next_candidates(2)], [6883, 6881])
+	assert_equals(len(peers.next_candidates(10)), 3)
+
+def test_banned_peers_are_not_candidates():
+	peers = registry(2)
+	peer = peers.get(host='10.0.0.1', port=6881)
+	peers.connect(peer)
+	peers.ban(peer)
+	peers.disconnect(peer)
+	assert_true(peers.is_banned('10.0.0.1', 6881))
+	assert_equals([candidate.port for candidate in peers.candidates], [6882])
+
+def test_remove():
+	peers = registry(2)
+	peer = peers.get(host='10.0.0.1', port=6881)
+	peers.set_peer_id(peer, 'A' * 20)
+	peers.connect(peer)
+	peers.remove(peer)
+	assert_false(peer in peers)
+	assert_equals(peers.get('A' * 20), None)
+	assert_false(peers.is_connected(peer))
@@ -0,0 +1,84 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from BitPy.bitfield import Bitfield
+from BitPy.picker import PiecePicker
+
+def bitfield(pieces, length=8):
+	result = Bitfield(length)
+	for piece in pieces:
+		result.add(piece)
+	return result
+
+def check_invariants(picker):
+	assert_equals(sorted(picker.order), range(len(picker.order)))
+	availabilities = [picker.availability[piece] for piece in picker.order]
+	assert_equals(availabilities, sorted(availabilities))
+	for (position, piece) in enumerate(picker.order):
+		assert_equals(picker.position[piece], position)
+		available = picker.availability[piece]
+		assert_true(picker.starts[available] <= position < picker.starts[available + 1])
+
+def test_availability_counts():
+	picker = PiecePicker(8)
+	picker.add_peer(bitfield([0, 1, 2]))
+	picker.add_peer(bitfield([1, 2]))
+	picker.add_peer(bitfield([2, 7]))
+	check_invariants(picker)
+	assert_equals(list(picker.availability), [1, 2, 3, 0, 0, 0, 0, 1])
+	picker.remove_peer(bitfield([1, 2]))
+	check_invariants(picker)
+	assert_equals(list(picker.availability), [1, 1, 2, 0, 0, 0, 0, 1])
+
+def test_decrement_below_zero_ignored():
+	picker = PiecePicker(4)
+	picker.decrement(2)
+	check_invariants(picker)
+	assert_equals(picker.availability[2], 0)
+
+def test_rarest_first():
+	picker = PiecePicker(8)
+	picker.add_peer(bitfield([0, 1, 2, 3]))
+	picker.add_peer(bitfield([0, 1, 2]))
+	picker.add_peer(bitfield([0, 1]))
+	picker.add_peer(bitfield([0]))
+	assert_equals(list(picker.pick(bitfield([0, 1, 2, 3]), bitfield([]))), [3, 2, 1, 0])
+
+def test_pick_skips_pieces_we_have_and_prefers_partial():
+	picker = PiecePicker(8)
+	picker.add_peer(bitfield([0, 1, 2, 3]))
+	picker.add_peer(bitfield([0, 1, 2]))
+	picker.add_peer(bitfield([4]))
+	picks = list(picker.pick(bitfield([0, 1, 2, 3, 4]), bitfield([3]), {1: [(0, 10)]}))
+	assert_equals(picks[0], 1)
+	assert_equals(sorted(picks), [0, 1, 2, 4])
+	assert_equals(picks[1], 4)
+
+def test_random_tie_breaking():
+	orders = set(tuple(PiecePicker(16).order) for _ in range(10))
+	assert_true(len(orders) > 1)
+
+class Pieces(object):
+	"""A peer's pieces, recording which are asked about."""
+	def __init__(self, pieces):
+		self.pieces = pieces
+		self.asked = set()
+
+	def __contains__(self, piece):
+		self.asked.add(piece)
+		return piece in self.pieces
+
+def test_pick_is_lazy():
+	picker = PiecePicker(64)
+	picker.add_peer(bitfield(range(64), 64))
+	picker.add_peer(bitfield(range(8, 64), 64))
+	peer_pieces = Pieces(bitfield(range(64), 64))
+	picks = picker.pick(peer_pieces, bitfield([], 64))
+	assert_true(next(picks) < 8)
+	# Only the rarest band was looked at
+	assert_true(max(peer_pieces.asked) < 8)
+
+def test_ties_broken_on_each_pick():
+	picker = PiecePicker(16)
+	picker.add_peer(bitfield(range(16), 16))
+	firsts = set(next(picker.pick(bitfield(range(16), 16), bitfield([], 16))) for _ in range(20))
+	assert_true(len(firsts) > 1)
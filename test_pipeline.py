@@ -0,0 +1,43 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from BitPy.pipeline import Pipeline
+
+def test_slow_start():
+	pipeline = Pipeline(min_depth=2)
+	assert_equals(pipeline.room, 2)
+	pipeline.sent(0, 0, 16384, 0.0)
+	pipeline.sent(0, 16384, 16384, 0.0)
+	assert_equals(pipeline.room, 0)
+	assert_true(pipeline.received(0, 0, 16384, 0.1))
+	assert_equals(pipeline.depth, 3)
+	assert_equals(pipeline.room, 2)
+
+def test_depth_follows_bandwidth_delay_product():
+	pipeline = Pipeline(min_depth=2, rate_window=1.0)
+	now = 0.0
+	# 10 blocks a second with a 0.5s round trip
+	for block in range(20):
+		pipeline.sent(0, block, 16384, now)
+		now += 0.1
+		pipeline.received(0, block, 16384, now + 0.4)
+	assert_true(abs(pipeline.min_rtt - 0.5) < 1e-9)
+	assert_true(100000 < pipeline.rate < 400000)
+	assert_equals(pipeline.depth, int(2 * pipeline.rate * 0.5 / 16384) + 2)
+
+def test_depth_is_capped():
+	pipeline = Pipeline(max_depth=5)
+	pipeline.rate = 1e9
+	pipeline.min_rtt = 1.0
+	assert_equals(pipeline.depth, 5)
+
+def test_unrequested_and_cleared_blocks():
+	pipeline = Pipeline()
+	assert_false(pipeline.received(0, 0, 16384, 1.0))
+	pipeline.sent(1, 0, 16384, 0.0)
+	pipeline.sent(2, 0, 16384, 0.0)
+	assert_true((1, 0) in pipeline)
+	assert_true(pipeline.cancel(1, 0))
+	assert_false(pipeline.cancel(1, 0))
+	assert_equals(pipeline.clear(), [(2, 0)])
+	assert_equals(len(pipeline), 0)
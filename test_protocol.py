@@ -2,7 +2,7 @@ from nose.twistedtools import reactor, deferred
 import nose.twistedtools
 import BitPy.client
 import BitPy.protocol
-import BitPy.torrents
+import BitPy.verify
 import logging
 
 
@@ -12,20 +12,22 @@ from twisted.test import proto_helpers
 from nose.tools import assert_equals
 from nose.tools import assert_true
 from nose.tools import assert_false
+from nose.tools import assert_raises
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
 
+import random
 import tempfile
 
-def get_torrent():
-	return BitPy.torrents.load_torrent_file("ubuntu-15.10-desktop-amd64.iso.torrent")
+from fixtures import make_torrent
 
 class TestClient(unittest.TestCase):
 	def setUp(self):
-		self.torrent = get_torrent()
-		self.torrent.info.pieces = ['3495ff69d34671d1e15b33a63c1379fdedd3a32a'.decode('hex') for _ in range(0,3)]
-		self.torrent.info.piece_length=10
-		self.torrent.info.size = 30
+		self.torrent = make_torrent('a'*30, 10)
 
 		self.client = BitPy.client.Client(self.torrent, file=tempfile.SpooledTemporaryFile())
+		# Hash completed pieces inline so their results can be checked straight away
+		self.client.download.hash_queue = BitPy.verify.HashQueue(run=defer.maybeDeferred)
 		factory = BitPy.protocol.PeerClientFactory(self.client)
 
 		self.proto = factory.buildProtocol(('127.0.0.1', 0))
@@ -83,39 +85,341 @@ class TestClient(unittest.TestCase):
 
 	def test_bitfield(self):
 		self.send('\x05' + '\xf0')
-		assert_equals(self.proto.peer.bitfield, ['\xf0'])
+		# Only 3 pieces, so the spare bit is dropped
+		assert_equals(self.proto.peer.bitfield.tobytes(), '\xe0')
+		assert_equals(list(self.proto.peer.bitfield), [0,1,2])
 
 	def test_request(self):
+		self.send('\x07' + '\x00\x00\x00\x00' + '\x00\x00\x00\x00' + 'a'*10)
+		self.client.choker.unchoke(self.proto.peer)
+		self.proto.uploader.pauseProducing()
 		self.send('\x06' + '\x00\x00\x00\x00' + '\x00\x00\x00\x00' + '\x00\x00\x00\x01')
 		assert_equals(self.proto.connected, 1)
 		assert_equals(self.proto.state, 'ACTIVE')
-		assert_equals(self.client.connected_peers[0].requests[0], (0,0,1))
+		assert_equals(list(self.proto.peer.requests), [(0,0,1)])
 
 
 	def test_store(self):
-		self.torrent.info.piece_length = 10
 		self.send('\x07' + '\x00\x00\x00\x00' + '\x00\x00\x00\x00' + 'a'*10)
 		assert_equals(self.client.download.get_piece(0), 'a'*10)
 
 	def test_handle_request(self):
 		self.send('\x07' + '\x00\x00\x00\x00' + '\x00\x00\x00\x00' + 'a'*10)
-		self.send('\x06' + struct.pack('!III',0,0,10))
-		peer = self.client.connected_peers[0]
+		peer = self.proto.peer
+		self.client.choker.unchoke(peer)
 		self.tr.clear()
-		self.client.handle_request(peer, peer.requests[0])
+		self.send('\x06' + struct.pack('!III',0,0,10))
 		response = '\07'+struct.pack('!II',0,0)+'a'*10
 		assert_equals(self.tr.value(),struct.pack('!I',len(response)) + response)
+		assert_equals(len(peer.requests), 0)
+
+	def test_requests_wait_while_transport_is_full(self):
+		self.send('\x07' + struct.pack('!II', 0, 0) + 'a'*10)
+		self.client.choker.unchoke(self.proto.peer)
+		self.tr.clear()
+		self.proto.uploader.pauseProducing()
+		self.send('\x06' + struct.pack('!III', 0, 0, 5))
+		self.send('\x06' + struct.pack('!III', 0, 5, 5))
+		assert_equals(self.tr.value(), '')
+		self.proto.uploader.resumeProducing()
+		assert_equals(len(self.tr.value()), 2 * (4 + 9 + 5))
+
+	def test_bad_requests_are_rejected(self):
+		peer = self.proto.peer
+		self.proto.uploader.pauseProducing()
+		self.send('\x07' + struct.pack('!II', 0, 0) + 'a'*10)
+		# Choked
+		self.send('\x06' + struct.pack('!III', 0, 0, 10))
+		self.client.choker.unchoke(peer)
+		# A piece we don't have, past the end of the piece, and too big
+		self.send('\x06' + struct.pack('!III', 1, 0, 10))
+		self.send('\x06' + struct.pack('!III', 0, 5, 10))
+		self.send('\x06' + struct.pack('!III', 0, 0, 2**17 + 1))
+		assert_equals(len(peer.requests), 0)
+		self.client.max_upload_requests = 2
+		self.send('\x06' + struct.pack('!III', 0, 0, 5))
+		self.send('\x06' + struct.pack('!III', 0, 0, 5))
+		self.send('\x06' + struct.pack('!III', 0, 5, 5))
+		self.send('\x06' + struct.pack('!III', 0, 0, 10))
+		assert_equals(list(peer.requests), [(0, 0, 5), (0, 5, 5)])
 
 	def test_get_pieces_to_send(self):
 		self.send('\x07' + '\x00\x00\x00\x00' + '\x00\x00\x00\x00' + 'a'*10)
 		self.send('\x07' + '\x00\x00\x00\x01' + '\x00\x00\x00\x00' + 'a'*10)
 		self.send('\x07' + '\x00\x00\x00\x02' + '\x00\x00\x00\x00' + 'a'*10)
-		peer = self.client.connected_peers[0]
-		assert_equals(peer.bitfield,['\x00'])
+		peer = self.proto.peer
+		assert_equals(peer.bitfield.tobytes(),'\x00')
 		assert_equals(list(self.client.get_pieces_to_send(peer)), [0,1,2])
 
 	def test_get_pieces_to_request(self):
-		peer = self.client.connected_peers[0]
-		[peer.set_have(piece) for piece in range(0,4)]
-		assert_equals(self.client.download.bitfield, ['\x00'])
-		assert_equals(list(self.client.get_pieces_to_request(peer)), [0,1,2,3])
+		peer = self.proto.peer
+		[peer.set_have(piece) for piece in range(0,3)]
+		assert_equals(self.client.download.bitfield.tobytes(), '\x00')
+		assert_equals(list(self.client.get_pieces_to_request(peer)), [0,1,2])
+
+	def test_send_piece(self):
+		self.tr.clear()
+		self.proto.send_PIECE(1, 16384, 'b'*10)
+		message = '\x07' + struct.pack('!II', 1, 16384) + 'b'*10
+		assert_equals(self.tr.value(), struct.pack('!I', len(message)) + message)
+
+	def test_availability_follows_bitfield_and_have(self):
+		self.send('\x05' + '\xa0')
+		self.send('\x04' + struct.pack('!I', 1))
+		self.send('\x04' + struct.pack('!I', 1))
+		assert_equals(list(self.client.picker.availability), [1, 1, 1])
+		self.proto.connectionLost(None)
+		assert_equals(list(self.client.picker.availability), [0, 0, 0])
+
+	def test_requests_fill_pipeline(self):
+		self.tr.clear()
+		self.send('\x05' + '\xe0')
+		assert_equals(self.tr.value(), struct.pack('!IB', 1, 2))
+		self.tr.clear()
+		self.send('\x01')
+		peer = self.proto.peer
+		assert_equals(len(peer.pipeline), peer.pipeline.min_depth)
+		requests = self.tr.value()
+		assert_equals(len(requests), 17 * peer.pipeline.min_depth)
+		(index, begin, length) = struct.unpack('!3I', requests[5:17])
+		assert_equals((begin, length), (0, 10))
+		self.tr.clear()
+		self.send('\x07' + struct.pack('!II', index, 0) + 'a'*10)
+		assert_true((index, 0) not in self.client.requested_parts)
+		# The pipeline is refilled with the one piece left. The peer has
+		# the piece, so it isn't sent a HAVE for it.
+		assert_equals(len(peer.pipeline), 2)
+		assert_equals(len(self.tr.value()), 17)
+		self.client.haves.flush()
+		assert_equals(len(self.tr.value()), 17)
+		assert_equals(len(self.client.requested_parts), 2)
+
+	def test_choke_releases_requests(self):
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		assert_equals(len(self.client.requested_parts), 2)
+		self.send('\x00')
+		assert_equals(len(self.client.requested_parts), 0)
+		assert_equals(len(self.proto.peer.pipeline), 0)
+
+	def test_requests_time_out(self):
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		assert_equals(len(self.client.request_timers), 2)
+		index = struct.unpack('!I', self.tr.value()[-12:-8])[0]
+		self.send('\x07' + struct.pack('!II', index, 0) + 'a'*10)
+		assert_true((self.proto.peer, index, 0) not in self.client.request_timers)
+		self.tr.clear()
+		self.client.request_timers.last_tick -= self.client.request_timeout + 1
+		self.client.expire_requests()
+		# The expired blocks are asked for again
+		assert_equals(len(self.tr.value()), 17 * 2)
+		assert_equals(len(self.client.request_timers), 2)
+		assert_equals(len(self.client.requested_parts), 2)
+
+	def connect_second_peer(self):
+		proto = BitPy.protocol.PeerClientFactory(self.client).buildProtocol(('10.0.0.2', 6881))
+		tr = proto_helpers.StringTransport(peerAddress=IPv4Address('TCP', '10.0.0.2', 6881))
+		proto.makeConnection(tr)
+		proto.dataReceived(self.get_handshake(info_hash=self.torrent.info_hash, peer_id='C'*20))
+		tr.clear()
+		return (proto, tr)
+
+	def test_bad_bitfield_drops_peer(self):
+		self.send('\x05' + '\xe0')
+		for bits in ('\xe0\x00', ''):
+			self.send('\x05' + bits)
+			assert_true(self.tr.disconnecting)
+			# The peer's pieces are still counted once
+			assert_equals(list(self.client.picker.availability), [1, 1, 1])
+			self.tr.disconnecting = False
+			self.proto.state = 'ACTIVE'
+
+	def test_haves_batched(self):
+		(other, other_tr) = self.connect_second_peer()
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		self.send('\x07' + struct.pack('!II', 0, 0) + 'a'*10)
+		self.send('\x07' + struct.pack('!II', 1, 0) + 'a'*10)
+		assert_equals(other_tr.value(), '')
+		self.client.haves.flush()
+		# Both pieces in one write, and none to the peer that has them
+		assert_equals(other_tr.value(), struct.pack('!IBI', 5, 4, 0) + struct.pack('!IBI', 5, 4, 1))
+		assert_true(struct.pack('!IB', 5, 4) not in self.tr.value())
+
+	def test_lazy_bitfield(self):
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		self.send('\x07' + struct.pack('!II', 0, 0) + 'a'*10)
+		self.send('\x07' + struct.pack('!II', 1, 0) + 'a'*10)
+		self.client.lazy_bitfield = 1
+		proto = BitPy.protocol.PeerClientFactory(self.client).buildProtocol(('10.0.0.2', 6881))
+		tr = proto_helpers.StringTransport(peerAddress=IPv4Address('TCP', '10.0.0.2', 6881))
+		proto.makeConnection(tr)
+		proto.dataReceived(self.get_handshake(info_hash=self.torrent.info_hash, peer_id='C'*20))
+		messages = tr.value()[68:]
+		(bitfield, held) = (messages[:6], messages[6:])
+		(piece,) = struct.unpack('!I', held[5:])
+		assert_equals(held[:5], struct.pack('!IB', 5, 4))
+		# The bitfield has the other piece we have
+		assert_equals(bitfield, struct.pack('!IB', 2, 5) + ('\x40' if piece == 0 else '\x80'))
+
+	def test_endgame_duplicates_and_cancels(self):
+		(other, other_tr) = self.connect_second_peer()
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		assert_equals(len(self.proto.peer.pipeline), 2)
+		other.dataReceived(struct.pack('!IB', 2, 5) + '\xe0')
+		other.dataReceived(struct.pack('!IB', 1, 1))
+		assert_true(self.client.endgame)
+		# The second peer gets the last unrequested block, and a duplicate
+		# of one already asked of the first
+		assert_equals(len(other.peer.pipeline), 2)
+		assert_equals(len(self.client.requested_parts), 3)
+		shared = [block for block in other.peer.pipeline.outstanding if block in self.proto.peer.pipeline]
+		assert_equals(len(shared), 1)
+		(index, begin) = shared[0]
+		length = 10
+		other_tr.clear()
+		self.send('\x07' + struct.pack('!II', index, begin) + 'a'*length)
+		assert_true((index, begin) not in other.peer.pipeline)
+		assert_true(struct.pack('!IB3I', 13, 8, index, begin, length) in other_tr.value())
+
+	def test_failed_hash_leaves_endgame(self):
+		(other, other_tr) = self.connect_second_peer()
+		self.send('\x05' + '\xe0')
+		self.send('\x01')
+		other.dataReceived(struct.pack('!IB', 2, 5) + '\xe0')
+		other.dataReceived(struct.pack('!IB', 1, 1))
+		assert_true(self.client.endgame)
+		self.client.endgame_blocks = 2
+		(index, begin) = list(self.proto.peer.pipeline.outstanding)[0]
+		self.send('\x07' + struct.pack('!II', index, begin) + 'b'*10)
+		# All three pieces are wanted again
+		assert_false(self.client.endgame)
+
+	def test_cancel_drops_queued_upload(self):
+		self.proto.peer.add_request(0, 0, 10, 1)
+		self.send('\x08' + struct.pack('!3I', 0, 0, 10))
+		assert_equals(len(self.proto.peer.requests), 0)
+
+	def test_banned_peer_is_dropped(self):
+		self.client.ban_peer(self.proto.peer)
+		assert_true(self.tr.disconnecting)
+		proto = BitPy.protocol.PeerClientFactory(self.client).buildProtocol(('127.0.0.1', 0))
+		tr = proto_helpers.StringTransport()
+		proto.makeConnection(tr)
+		proto.dataReceived(self.get_handshake(info_hash=self.torrent.info_hash))
+		assert_true(tr.disconnecting)
+		assert_equals(proto.peer, None)
+
+	def test_not_interested_once_peer_has_nothing_we_need(self):
+		self.tr.clear()
+		self.send('\x05' + '\x80')
+		assert_equals(self.tr.value(), struct.pack('!IB', 1, 2))
+		self.send('\x04' + struct.pack('!I', 1))
+		# Already interested, so nothing more is sent
+		assert_equals(self.tr.value(), struct.pack('!IB', 1, 2))
+		self.send('\x01')
+		self.tr.clear()
+		self.send('\x07' + struct.pack('!II', 0, 0) + 'a'*10)
+		self.send('\x07' + struct.pack('!II', 1, 0) + 'a'*10)
+		assert_false(self.proto.peer.am_interested)
+		assert_true(self.tr.value().endswith(struct.pack('!IB', 1, 3)))
+
+	def test_reading_paused_over_download_limit(self):
+		self.proto.peer.bandwidth.download.set_rate(1000, burst=0)
+		self.send('\x04' + struct.pack('!I', 1))
+		assert_equals(self.tr.producerState, 'paused')
+		self.proto.throttle.stop()
+
+	def test_unknown_message_is_skipped(self):
+		self.send('\x14' + 'extension')
+		self.send('\x04' + struct.pack('!I', 1))
+		assert_equals(list(self.proto.peer.bitfield), [1])
+
+	def test_several_messages_in_one_read(self):
+		messages = ['\x04' + struct.pack('!I', index) for index in range(3)]
+		self.proto.dataReceived("".join(struct.pack('!I', len(message)) + message for message in messages))
+		assert_equals(list(self.proto.peer.bitfield), [0, 1, 2])
+
+	def test_kept_payload_view_blocks_trimming(self):
+		kept = []
+		self.proto.handlers[4] = kept.append
+		message = struct.pack('!IBI', 5, 4, 1)
+		# Split so the message is parsed out of the buffer kept between reads
+		self.proto.dataReceived(message[:3])
+		assert_raises(BufferError, self.proto.dataReceived, message[3:])
+		assert_equals(kept[0].tobytes(), struct.pack('!I', 1))
+
+	def test_oversized_message_drops_connection(self):
+		self.proto.dataReceived(struct.pack('!I', 2**24))
+		assert_true(self.tr.disconnecting)
+
+class TestStreamSplitting(unittest.TestCase):
+	"""
+	Feed the same stream of a handshake followed by messages to new
+	connections, split into chunks at random boundaries, and check every
+	split is parsed the same.
+	"""
+
+	def setUp(self):
+		self.torrent = make_torrent('a'*30, 10)
+		handshake = "".join(['\x13', 'BitTorrent protocol', '\x00'*8, self.torrent.info_hash, 'B'*20])
+		messages = [
+			'\x05' + '\xa0',
+			'\x04' + struct.pack('!I', 1),
+			'\x02',
+			'',
+			'\x01',
+		]
+		self.stream = handshake + "".join(struct.pack('!I', len(message)) + message for message in messages)
+
+	def receive(self, chunks):
+		client = BitPy.client.Client(self.torrent, file=tempfile.SpooledTemporaryFile())
+		client.download.hash_queue = BitPy.verify.HashQueue(run=defer.maybeDeferred)
+		proto = BitPy.protocol.PeerClientFactory(client).buildProtocol(('127.0.0.1', 0))
+		proto.makeConnection(proto_helpers.StringTransport())
+		for chunk in chunks:
+			proto.dataReceived(chunk)
+		return proto
+
+	def check(self, proto):
+		peer = proto.peer
+		assert_equals(proto.state, 'ACTIVE')
+		assert_equals(peer.peer_id, 'B'*20)
+		assert_equals(list(peer.bitfield), [0, 1, 2])
+		assert_true(peer.interested)
+		assert_false(peer.choked)
+		# Asked for blocks once unchoked
+		assert_equals(len(peer.pipeline), peer.pipeline.min_depth)
+
+	def test_one_chunk(self):
+		self.check(self.receive([self.stream]))
+
+	def test_byte_at_a_time(self):
+		self.check(self.receive(list(self.stream)))
+
+	def random_splits(self, stream):
+		generator = random.Random(1234)
+		for _ in range(50):
+			cuts = sorted(generator.sample(xrange(1, len(stream)), generator.randint(1, 10)))
+			chunks = [stream[start:end] for (start, end) in zip([0] + cuts, cuts + [len(stream)])]
+			assert_equals("".join(chunks), stream)
+			yield chunks
+
+	def test_random_splits(self):
+		for chunks in self.random_splits(self.stream):
+			self.check(self.receive(chunks))
+
+	def test_nothing_handled_after_drop(self):
+		# A HAVE for a piece past the end drops the peer, so what follows
+		# it in the same read is ignored
+		stream = self.stream[:68] + struct.pack('!IBI', 5, 4, 99) + self.stream[68:]
+		for chunks in [[stream]] + list(self.random_splits(stream)):
+			proto = self.receive(chunks)
+			assert_equals(proto.state, 'CLOSED')
+			assert_true(proto.transport.disconnecting)
+			assert_equals(len(proto.peer.bitfield), 0)
+			assert_false(proto.peer.interested)
+
@@ -0,0 +1,176 @@
+from nose.twistedtools import reactor, deferred
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import assert_raises
+
+from twisted.internet import defer, protocol, task
+from twisted.test import proto_helpers
+
+from BitPy.ratelimit import TokenBucket, Throttle
+
+def test_bucket_refills_at_rate():
+	clock = task.Clock()
+	bucket = TokenBucket(1000, burst=500, clock=clock)
+	bucket.consume(1500)
+	assert_equals(bucket.delay, 1.0)
+	clock.advance(0.5)
+	assert_equals(bucket.delay, 0.5)
+	clock.advance(10)
+	assert_equals(bucket.delay, 0)
+	# Never more than a burst saved up
+	assert_equals(bucket.tokens, 500)
+
+def test_unlimited_bucket():
+	bucket = TokenBucket(clock=task.Clock())
+	bucket.consume(10**9)
+	assert_equals(bucket.delay, 0)
+
+def test_zero_rate_rejected():
+	assert_raises(ValueError, TokenBucket, 0, clock=task.Clock())
+	bucket = TokenBucket(1000, clock=task.Clock())
+	assert_raises(ValueError, bucket.set_rate, 0)
+	assert_equals(bucket.rate, 1000)
+
+def test_reading_paused_while_in_debt():
+	clock = task.Clock()
+	transport = proto_helpers.StringTransport()
+	throttle = Throttle(transport, download=[TokenBucket(1000, clock=clock), TokenBucket(clock=clock)], clock=clock)
+	throttle.received(500)
+	assert_equals(transport.producerState, 'producing')
+	throttle.received(1500)
+	assert_equals(transport.producerState, 'paused')
+	clock.advance(0.5)
+	assert_equals(transport.producerState, 'paused')
+	clock.advance(0.5)
+	assert_equals(transport.producerState, 'producing')
+
+def test_shared_bucket_keeps_reading_paused():
+	clock = task.Clock()
+	shared = TokenBucket(1000, burst=0, clock=clock)
+	transport = proto_helpers.StringTransport()
+	throttle = Throttle(transport, download=[shared], clock=clock)
+	throttle.received(1000)
+	clock.advance(0.5)
+	# Another connection spends what came in meanwhile
+	shared.consume(500)
+	clock.advance(0.5)
+	assert_equals(transport.producerState, 'paused')
+	clock.advance(0.5)
+	assert_equals(transport.producerState, 'producing')
+
+def test_uploads_blocked_while_in_debt():
+	clock = task.Clock()
+	transport = proto_helpers.StringTransport()
+	resumed = []
+	throttle = Throttle(transport, upload=[TokenBucket(1000, burst=0, clock=clock)], resume_uploads=lambda: resumed.append(True), clock=clock)
+	throttle.sent(2000)
+	assert_true(throttle.uploads_blocked)
+	assert_equals(transport.producerState, 'producing')
+	clock.advance(2)
+	assert_false(throttle.uploads_blocked)
+	assert_equals(resumed, [True])
+
+def test_uploads_without_producer_stop_reading():
+	clock = task.Clock()
+	transport = proto_helpers.StringTransport()
+	throttle = Throttle(transport, download=[TokenBucket(1000, burst=0, clock=clock)], upload=[TokenBucket(1000, burst=0, clock=clock)], clock=clock)
+	throttle.sent(1000)
+	throttle.received(2000)
+	clock.advance(1)
+	# Still paused for the download
+	assert_equals(transport.producerState, 'paused')
+	clock.advance(1)
+	assert_equals(transport.producerState, 'producing')
+
+class Source(protocol.Protocol):
+	"""Sends as fast as its transport and throttle allow."""
+	chunk = 'x' * 2**14
+
+	def connectionMade(self):
+		self.paused = False
+		self.throttle = Throttle(self.transport, upload=self.factory.upload, resume_uploads=self.produce)
+		self.transport.registerProducer(self, True)
+		self.produce()
+
+	def produce(self):
+		while not self.paused and not self.throttle.uploads_blocked and self.transport.connected:
+			self.transport.write(self.chunk)
+			self.throttle.sent(len(self.chunk))
+
+	def pauseProducing(self):
+		self.paused = True
+
+	def resumeProducing(self):
+		self.paused = False
+		self.produce()
+
+	def stopProducing(self):
+		self.paused = True
+
+	def connectionLost(self, reason):
+		self.throttle.stop()
+
+class Sink(protocol.Protocol):
+	def connectionMade(self):
+		self.throttle = Throttle(self.transport, download=self.factory.download)
+		self.factory.sinks.append(self)
+
+	def dataReceived(self, data):
+		self.throttle.received(len(data))
+		self.factory.received += len(data)
+
+	def connectionLost(self, reason):
+		self.throttle.stop()
+
+def measure(connections=1, upload=(), download=(), warmup=0.25, duration=1.0):
+	"""
+	Stream data over loopback through the given buckets, returning a
+	Deferred that fires with the rate received over duration seconds.
+	"""
+	source = protocol.Factory()
+	source.protocol = Source
+	source.upload = list(upload)
+	port = reactor.listenTCP(0, source, interface='127.0.0.1')
+	sink = protocol.ClientFactory()
+	sink.protocol = Sink
+	sink.download = list(download)
+	sink.sinks = []
+	sink.received = 0
+	for _ in range(connections):
+		reactor.connectTCP('127.0.0.1', port.getHost().port, sink)
+	result = defer.Deferred()
+	def start():
+		start_received = sink.received
+		def stop():
+			rate = (sink.received - start_received) / duration
+			for connection in sink.sinks:
+				connection.transport.loseConnection()
+			port.stopListening().addCallback(lambda _: result.callback(rate))
+		reactor.callLater(duration, stop)
+	reactor.callLater(warmup, start)
+	return result
+
+def assert_near(rate, cap, slack=0):
+	"""
+	Check a measured rate against its cap. Each connection may overdraw
+	by the one read that put it into debt, which slack allows for.
+	"""
+	assert_true(0.75 * cap <= rate <= 1.25 * cap + slack, "%d bytes/s against a cap of %d" % (rate, cap))
+
+@deferred(timeout=10)
+def test_download_cap_over_loopback():
+	cap = 256 * 1024
+	return measure(download=[TokenBucket(cap)]).addCallback(assert_near, cap)
+
+@deferred(timeout=10)
+def test_upload_cap_over_loopback():
+	cap = 256 * 1024
+	return measure(upload=[TokenBucket(cap)]).addCallback(assert_near, cap)
+
+@deferred(timeout=10)
+def test_shared_cap_over_loopback():
+	cap = 256 * 1024
+	# Three connections held to one cap between them
+	d = measure(connections=3, download=[TokenBucket(cap)], duration=2.0)
+	return d.addCallback(assert_near, cap, slack=3 * 2**16 / 2.0)
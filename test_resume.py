@@ -0,0 +1,67 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+import BitPy.client
+import BitPy.resume
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fixtures import make_multi_file_torrent
+
+class TestResume(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.files = [('a', 'a' * 25), ('b', 'b' * 15)]
+		self.torrent = make_multi_file_torrent(self.files, 10)
+		self.resume_file = os.path.join(self.directory, 'dir.resume')
+		os.mkdir(os.path.join(self.directory, 'dir'))
+		for (name, contents) in self.files:
+			with open(os.path.join(self.directory, 'dir', name), 'wb') as file:
+				file.write(contents)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def download(self):
+		return BitPy.client.Download(self.torrent, directory=self.directory, check=False)
+
+	def test_round_trip(self):
+		download = self.download()
+		download.check_progress()
+		download.pieces.discard(3)
+		download.piece_state[3] = [(0, 4)]
+		download.close()
+		assert_true(os.path.exists(self.resume_file))
+
+		resumed = self.download()
+		assert_false(resumed.needs_check)
+		assert_equals(list(resumed.pieces), [0, 1, 2])
+		assert_equals(resumed.piece_state, {3: [(0, 4)]})
+		resumed.close()
+
+	def test_changed_file_is_rechecked(self):
+		download = self.download()
+		download.check_progress()
+		download.close()
+		path = os.path.join(self.directory, 'dir', 'b')
+		os.utime(path, (0, 0))
+
+		resumed = self.download()
+		assert_true(resumed.needs_check)
+		assert_equals(list(resumed.pieces), [0, 1])
+		assert_equals(resumed.check_pieces, [2, 3])
+		assert_equals(resumed.check_progress(), 2)
+		assert_equals(list(resumed.pieces), [0, 1, 2, 3])
+		resumed.close()
+
+	def test_unusable_resume_data(self):
+		with open(self.resume_file, 'wb') as file:
+			file.write('garbage')
+		download = self.download()
+		assert_true(download.needs_check)
+		assert_equals(download.check_pieces, None)
+		assert_equals(download.check_progress(), 4)
+		download.close()
@@ -0,0 +1,161 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from nose.tools import raises
+import BitPy.storage
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fixtures import multi_file_info
+
+class TestStorage(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.storage = BitPy.storage.Storage(multi_file_info(), self.directory, pool=BitPy.storage.FilePool(2))
+
+	def tearDown(self):
+		self.storage.close()
+		shutil.rmtree(self.directory)
+
+	def path(self, *components):
+		return os.path.join(self.directory, 'dir', *components)
+
+	def test_allocate(self):
+		assert_false(self.storage.allocate())
+		assert_equals(os.path.getsize(self.path('a')), 7)
+		assert_equals(os.path.getsize(self.path('empty')), 0)
+		assert_equals(os.path.getsize(self.path('b','c')), 16)
+		assert_true(self.storage.allocate())
+
+	def test_write_across_files(self):
+		self.storage.allocate()
+		self.storage.write(0, 0, 'abcdefghij')
+		self.storage.write(2, 0, '12345')
+		self.storage.flush()
+		assert_equals(open(self.path('a')).read(), 'abcdefg')
+		assert_equals(open(self.path('b','c')).read(), 'hij' + '\0'*10 + '123')
+		assert_equals(open(self.path('d')).read(), '45')
+		assert_equals(self.storage.read(0, 5, 5), 'fghij')
+		assert_equals(self.storage.read(2, 2, 3), '345')
+
+	def test_pool_is_bounded(self):
+		self.storage.allocate()
+		for piece in range(3):
+			self.storage.read(piece, 0, self.storage.info.layout.piece_size(piece))
+		assert_equals(len(self.storage.pool.handles), 2)
+		assert_equals(self.storage.pool.handles.keys(), [self.path('b','c'), self.path('d')])
+
+@raises(ValueError)
+def test_unsafe_path():
+	BitPy.storage.safe_path(['..', 'etc', 'passwd'])
+
+class RecordingStorage(object):
+	def __init__(self):
+		self.writes = []
+		self.flushes = 0
+		self.data = {}
+
+	def write(self, piece, begin, data):
+		self.writes.append((piece, begin, data))
+		self.data[(piece, begin)] = data
+
+	def read(self, piece, begin, length):
+		for ((stored_piece, stored_begin), data) in self.data.iteritems():
+			if stored_piece == piece and stored_begin <= begin < stored_begin + len(data):
+				return data[begin - stored_begin:begin - stored_begin + length]
+		return ""
+
+	def flush(self):
+		self.flushes += 1
+
+class TestWriteCache(unittest.TestCase):
+	def setUp(self):
+		self.backend = RecordingStorage()
+		self.cache = BitPy.storage.WriteCache(self.backend, max_bytes=30, flush_bytes=20)
+
+	def test_blocks_held_until_commit(self):
+		self.cache.write(0, 5, 'fghij')
+		self.cache.write(0, 0, 'abcde')
+		assert_equals(self.backend.writes, [])
+		assert_equals(self.cache.read(0, 0, 10), 'abcdefghij')
+		assert_equals(self.cache.read(0, 3, 4), 'defg')
+		self.cache.commit(0)
+		assert_equals(self.backend.writes, [(0, 0, 'abcdefghij')])
+		assert_equals(self.cache.size, 0)
+
+	def test_runs_with_gaps(self):
+		self.cache.write(0, 0, 'ab')
+		self.cache.write(0, 4, 'ef')
+		self.cache.commit(0)
+		assert_equals(self.backend.writes, [(0, 0, 'ab'), (0, 4, 'ef')])
+
+	def test_discard(self):
+		self.cache.write(0, 0, 'abcde')
+		self.cache.discard(0)
+		self.cache.flush()
+		assert_equals(self.backend.writes, [])
+		assert_equals(self.cache.size, 0)
+
+	def test_evicts_oldest_piece_over_cap(self):
+		self.cache.write(0, 0, 'a' * 10)
+		self.cache.write(1, 0, 'b' * 10)
+		self.cache.write(0, 10, 'a' * 10)
+		self.cache.write(2, 0, 'c' * 10)
+		assert_equals(self.backend.writes, [(1, 0, 'b' * 10)])
+		assert_equals(self.cache.size, 30)
+
+	def test_read_across_gap_does_not_commit(self):
+		self.backend.write(0, 2, 'cd')
+		self.backend.writes = []
+		self.cache.write(0, 0, 'ab')
+		self.cache.write(0, 4, 'ef')
+		assert_equals(self.cache.read(0, 0, 6), 'abcdef')
+		assert_equals(self.cache.read(0, 1, 4), 'bcde')
+		assert_equals(self.backend.writes, [])
+		assert_equals(self.cache.size, 4)
+
+	def test_evicts_verified_piece_first(self):
+		self.cache.write(0, 0, 'a' * 10)
+		self.cache.write(1, 0, 'b' * 10)
+		self.cache.mark_verified(1)
+		self.cache.write(2, 0, 'c' * 10)
+		self.cache.write(3, 0, 'd' * 10)
+		assert_equals(self.backend.writes, [(1, 0, 'b' * 10)])
+		self.cache.write(4, 0, 'e' * 10)
+		assert_equals(self.backend.writes, [(1, 0, 'b' * 10), (0, 0, 'a' * 10)])
+
+	def test_flush_cadence(self):
+		self.cache.write(0, 0, 'a' * 10)
+		self.cache.commit(0)
+		assert_equals(self.backend.flushes, 0)
+		self.cache.write(1, 0, 'b' * 10)
+		self.cache.commit(1)
+		assert_equals(self.backend.flushes, 1)
+
+class TestReadCache(unittest.TestCase):
+	def setUp(self):
+		self.backend = RecordingStorage()
+		for piece in range(3):
+			self.backend.write(piece, 0, str(piece) * 10)
+		self.cache = BitPy.storage.ReadCache(self.backend, max_bytes=20)
+
+	def test_hits_and_misses(self):
+		assert_equals(self.cache.read(0, 2, 3, 10), '000')
+		assert_equals(self.cache.read(0, 0, 10, 10), '0' * 10)
+		assert_equals((self.cache.hits, self.cache.misses), (1, 1))
+
+	def test_evicts_least_recently_used(self):
+		self.cache.read(0, 0, 1, 10)
+		self.cache.read(1, 0, 1, 10)
+		self.cache.read(0, 0, 1, 10)
+		self.cache.read(2, 0, 1, 10)
+		assert_equals(self.cache.pieces.keys(), [0, 2])
+		assert_equals(self.cache.evictions, 1)
+		assert_equals(self.cache.size, 20)
+
+	def test_oversized_piece_not_cached(self):
+		self.cache.add(5, 'x' * 21)
+		assert_equals(self.cache.size, 0)
@@ -0,0 +1,53 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from BitPy.timers import TimerWheel
+
+def test_expires_after_timeout():
+	wheel = TimerWheel(30, resolution=1.0)
+	wheel.add('a', 1)
+	assert_equals(wheel.advance(29.5), [])
+	assert_equals(wheel.advance(30.5), [])
+	assert_equals(wheel.advance(31.0), [('a', 1)])
+	assert_equals(len(wheel), 0)
+
+def test_never_expires_early():
+	wheel = TimerWheel(3, resolution=1.0)
+	wheel.advance(0.9)
+	wheel.add('a')
+	assert_equals(wheel.advance(3.8), [])
+	assert_equals(wheel.advance(4.0), [('a', None)])
+
+def test_cancel():
+	wheel = TimerWheel(5)
+	wheel.add('a')
+	wheel.add('b')
+	assert_true(wheel.cancel('a'))
+	assert_false(wheel.cancel('a'))
+	assert_false('a' in wheel)
+	assert_equals(wheel.advance(100), [('b', None)])
+
+def test_expires_in_batches():
+	wheel = TimerWheel(2, resolution=0.5)
+	for key in range(3):
+		wheel.add(key)
+	wheel.advance(1.0)
+	wheel.add(3)
+	assert_equals(sorted(key for (key, _) in wheel.advance(2.5)), [0, 1, 2])
+	assert_equals(wheel.advance(3.5), [(3, None)])
+
+def test_add_restarts_timeout():
+	wheel = TimerWheel(2)
+	wheel.add('a')
+	wheel.advance(1)
+	wheel.add('a')
+	assert_equals(wheel.advance(3), [])
+	assert_equals(len(wheel), 1)
+	assert_equals(wheel.advance(4), [('a', None)])
+
+def test_set_time_skips_idle_ticks():
+	wheel = TimerWheel(2, now=0)
+	wheel.set_time(100)
+	wheel.add('a')
+	assert_equals(wheel.advance(101), [])
+	assert_equals(wheel.advance(103), [('a', None)])
@@ -1,11 +1,65 @@
 from nose.tools import assert_equals
 from nose.tools import assert_true
+from nose.tools import raises
 import BitPy.torrents
 
+from fixtures import multi_file_info
+
 def test_load_ubuntu():
 	file = BitPy.torrents.load_torrent_file("ubuntu-15.10-desktop-amd64.iso.torrent")
 	assert_equals(file.announce, "http://torrent.ubuntu.com:6969/announce")
 	assert_equals(file.creation_date, 1445507299)
 	assert_equals(file.info.filemode,'single')
 	assert_equals(file.info.files,[{'path':['ubuntu-15.10-desktop-amd64.iso'], 'length':1178386432, 'md5sum':None}])
-	assert_equals(file.info_hash.encode("hex"), '3f19b149f53a50e14fc0b79926a391896eabab6f')
\ No newline at end of file
+	assert_equals(file.info_hash.encode("hex"), '3f19b149f53a50e14fc0b79926a391896eabab6f')
+
+def test_info_hash_uses_original_encoding():
+	import hashlib, tempfile
+	# Keys out of order: re-encoding would sort them and change the hash
+	info = "d6:lengthi10e4:name1:a6:pieces20:" + "x"*20 + "12:piece lengthi10ee"
+	with tempfile.NamedTemporaryFile(suffix=".torrent") as torrentfile:
+		torrentfile.write("d8:announce3:url4:info" + info + "e")
+		torrentfile.flush()
+		file = BitPy.torrents.load_torrent_file(torrentfile.name)
+	assert_equals(file.info_hash, hashlib.sha1(info).digest())
+
+def test_load_lazy():
+	eager = BitPy.torrents.load_torrent_file("ubuntu-15.10-desktop-amd64.iso.torrent")
+	lazy = BitPy.torrents.load_torrent_file("ubuntu-15.10-desktop-amd64.iso.torrent", lazy=True)
+	assert_true(isinstance(lazy.info.pieces, BitPy.torrents.Pieces))
+	assert_equals(lazy.info_hash, eager.info_hash)
+	assert_equals(lazy.info.num_pieces, eager.info.num_pieces)
+	assert_equals(list(lazy.info.pieces), eager.info.pieces)
+	assert_equals(lazy.info.pieces[-1], eager.info.pieces[-1])
+	assert_equals(list(lazy.info.pieces[3:7]), eager.info.pieces[3:7])
+	assert_equals(lazy.info.pieces[1:9:3], eager.info.pieces[1:9:3])
+
+@raises(IndexError)
+def test_pieces_index_out_of_range():
+	BitPy.torrents.Pieces("x" * 40)[2]
+
+def test_multi_file_info():
+	info = multi_file_info()
+	assert_equals(info.filemode, 'multiple')
+	assert_equals(info.files[2]['path'], ['b','c'])
+	assert_equals(info.size, 25)
+	assert_equals([info.layout.piece_size(i) for i in range(3)], [10, 10, 5])
+
+def test_layout_locate():
+	layout = multi_file_info().layout
+	assert_equals(layout.locate(0, 0, 10), [(0, 0, 7), (2, 0, 3)])
+	assert_equals(layout.locate(1, 5, 5), [(2, 8, 5)])
+	assert_equals(layout.locate(2, 0, 5), [(2, 13, 3), (3, 0, 2)])
+	assert_equals(layout.locate(0, 7, 0), [])
+
+@raises(ValueError)
+def test_layout_locate_past_end():
+	multi_file_info().layout.locate(2, 0, 6)
+
+def test_layout_follows_added_files():
+	info = multi_file_info()
+	layout = info.layout
+	assert_true(info.layout is layout)
+	info.add_file(['e'], 5)
+	assert_equals(info.size, 30)
+	assert_equals(info.layout.piece_size(2), 10)
@@ -0,0 +1,117 @@
+from nose.twistedtools import reactor, deferred
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+
+from twisted.internet import defer
+from twisted.web import resource, server
+
+import BitPy.bencode
+from BitPy.tracker import Tracker, TrackerError
+
+class FakeTracker(resource.Resource):
+	"""
+	A tracker on a local port that records the announces it gets and
+	answers each with response, or doesn't answer at all if hang is set.
+	"""
+	isLeaf = True
+
+	def __init__(self, response=None, code=200, hang=False):
+		resource.Resource.__init__(self)
+		self.response = response if response is not None else {'interval': 1800, 'peers': ''}
+		self.code = code
+		self.hang = hang
+		self.announces = []
+		self.port = None
+
+	def render_GET(self, request):
+		self.announces.append(request.args)
+		if self.hang:
+			return server.NOT_DONE_YET
+		request.setResponseCode(self.code)
+		return BitPy.bencode.bencode(self.response)
+
+	def listen(self):
+		self.port = reactor.listenTCP(0, server.Site(self), interface='127.0.0.1')
+		return self
+
+	@property
+	def url(self):
+		return 'http://127.0.0.1:%d/announce' % self.port.getHost().port
+
+	def stop(self):
+		return self.port.stopListening()
+
+def finish(d, tracker, *fakes):
+	"""Close the tracker's connections and stop the fake trackers once d fires."""
+	def cleanup(result):
+		closed = [tracker.close()] + [fake.stop() for fake in fakes]
+		return defer.DeferredList(closed).addCallback(lambda _: result)
+	return d.addBoth(cleanup)
+
+@deferred(timeout=5)
+def test_announce():
+	fake = FakeTracker({'interval': 900, 'min interval': 1200, 'peers': 'abcdef'}).listen()
+	tracker = Tracker(fake.url, timeout=2)
+	def check(response):
+		assert_equals(response['peers'], 'abcdef')
+		assert_equals(fake.announces[0]['info_hash'], ['\x00\xff' * 10])
+		assert_equals(fake.announces[0]['event'], ['started'])
+		# The min interval is longer than the interval
+		assert_equals(tracker.delay, 1200)
+	d = tracker.announce({'info_hash': '\x00\xff' * 10, 'event': 'started'})
+	return finish(d.addCallback(check), tracker, fake)
+
+@deferred(timeout=5)
+def test_tiers_fail_over():
+	broken = FakeTracker(code=500).listen()
+	failing = FakeTracker({'failure reason': 'unregistered torrent'}).listen()
+	working = FakeTracker().listen()
+	tracker = Tracker(None, [[broken.url], [failing.url, working.url]], timeout=2)
+	tracker.tiers[1] = [failing.url, working.url]
+	def check(response):
+		assert_equals(response['interval'], 1800)
+		assert_equals([len(fake.announces) for fake in (broken, failing, working)], [1, 1, 1])
+		# The tracker that answered moves to the front of its tier
+		assert_equals(tracker.tiers, [[broken.url], [working.url, failing.url]])
+		assert_equals(tracker.failures, 0)
+	d = tracker.announce({'info_hash': 'A' * 20})
+	return finish(d.addCallback(check), tracker, broken, failing, working)
+
+@deferred(timeout=5)
+def test_backoff_when_no_tracker_answers():
+	fake = FakeTracker(hang=True).listen()
+	tracker = Tracker(fake.url, timeout=0.2, retry_delay=10)
+	def failed(failure):
+		failure.trap(TrackerError)
+		assert_equals(tracker.failures, 1)
+		assert_equals(tracker.delay, 10)
+		return tracker.announce({'info_hash': 'A' * 20}).addCallbacks(unexpected, failed_again)
+	def failed_again(failure):
+		failure.trap(TrackerError)
+		assert_equals(tracker.delay, 20)
+	def unexpected(response):
+		raise AssertionError("Announce to a hung tracker succeeded")
+	d = tracker.announce({'info_hash': 'A' * 20}).addCallbacks(unexpected, failed)
+	return finish(d, tracker, fake)
+
+def test_backoff_is_capped():
+	tracker = Tracker('http://localhost/announce', retry_delay=15, max_backoff=60)
+	tracker.failures = 10
+	assert_equals(tracker.delay, 60)
+
+@deferred(timeout=5)
+def test_unsupported_tracker_is_skipped():
+	fake = FakeTracker().listen()
+	tracker = Tracker(None, [['udp://tracker.example:80'], [fake.url]], timeout=2)
+	def check(response):
+		assert_equals(len(fake.announces), 1)
+	d = tracker.announce({'info_hash': 'A' * 20})
+	return finish(d.addCallback(check), tracker, fake)
+
+def test_no_trackers():
+	tracker = Tracker(None, [[''], []])
+	assert_equals(tracker.tiers, [])
+	failures = []
+	tracker.announce({'info_hash': 'A' * 20}).addErrback(failures.append)
+	failures[0].trap(TrackerError)
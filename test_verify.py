@@ -0,0 +1,96 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import assert_false
+from twisted.internet import defer
+import BitPy.client
+import BitPy.storage
+import BitPy.torrents
+import BitPy.verify
+
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from fixtures import make_torrent
+
+def test_batches():
+	layout = BitPy.torrents.Layout([95], 10, 10)
+	assert_equals(list(BitPy.verify.batches(layout, [0,1,2,3,5,6,9], 30)), [[0,1,2],[3],[5,6],[9]])
+
+def test_verify_pieces():
+	data = "".join(chr(65 + i) * 10 for i in range(9)) + "Z" * 5
+	torrent = make_torrent(data, 10)
+	file = tempfile.TemporaryFile()
+	file.write(data[:30] + "?" + data[31:])
+	storage = BitPy.storage.FileStorage(torrent.info, file)
+	results = list(BitPy.verify.verify_pieces(storage, torrent.info, threads=2, batch_bytes=20))
+	assert_equals(results, [(0,True),(1,True),(2,True),(3,False)] + [(i,True) for i in range(4,10)])
+
+class TestCheckProgress(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.data = "".join(chr(65 + i) * 10 for i in range(5))
+		self.torrent = make_torrent(self.data, 10)
+		with open(self.directory + "/data.bin", "wb") as file:
+			file.write(self.data[:20] + "?" * 10 + self.data[30:])
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def test_check_progress(self):
+		download = BitPy.client.Download(self.torrent, directory=self.directory, check=False)
+		assert_true(download.needs_check)
+		assert_equals(download.check_progress(workers=2), 4)
+		assert_equals(list(download.pieces), [0,1,3,4])
+		download.close()
+
+class TestHashQueue(unittest.TestCase):
+	def setUp(self):
+		self.jobs = []
+		def run(function, *args):
+			d = defer.Deferred()
+			self.jobs.append((d, function, args))
+			return d
+		self.queue = BitPy.verify.HashQueue(max_jobs=2, max_pending=3, run=run)
+
+	def finish(self, index):
+		(d, function, args) = self.jobs[index]
+		d.callback(function(*args))
+
+	def test_limits_running_jobs(self):
+		results = []
+		for data in ['a', 'b', 'c']:
+			self.queue.sha1(data).addCallback(results.append)
+		assert_equals(len(self.jobs), 2)
+		assert_true(self.queue.full)
+		self.finish(0)
+		assert_equals(results, [hashlib.sha1('a').digest()])
+		assert_equals(len(self.jobs), 3)
+		assert_false(self.queue.full)
+
+	def test_store_piece_hashes_through_queue(self):
+		torrent = make_torrent('a' * 20, 10)
+		download = BitPy.client.Download(torrent, file=tempfile.TemporaryFile(), hash_queue=self.queue)
+		assert_equals(download.store_piece(0, 0, 'a' * 5), None)
+		verified = download.store_piece(0, 5, 'a' * 5)
+		results = []
+		verified.addCallback(results.append)
+		assert_false(download.have_piece(0))
+		assert_equals(download.store_piece(0, 0, 'a' * 5), None)
+		self.finish(0)
+		assert_equals(results, [True])
+		assert_true(download.have_piece(0))
+
+	def test_failed_hash_discards_piece(self):
+		torrent = make_torrent('a' * 20, 10)
+		download = BitPy.client.Download(torrent, file=tempfile.TemporaryFile(), hash_queue=self.queue)
+		results = []
+		download.store_piece(0, 0, 'a' * 10).addCallback(results.append)
+		self.jobs[0][0].errback(RuntimeError("thread pool stopped"))
+		assert_equals(results, [False])
+		assert_false(download.have_piece(0))
+		# The piece can be downloaded again
+		download.store_piece(0, 0, 'a' * 10).addCallback(results.append)
+		self.finish(1)
+		assert_equals(results, [False, True])